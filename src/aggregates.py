@@ -0,0 +1,281 @@
+"""
+This document maintains weekly aggregates of the stored records and builds the progress report (report mode).
+
+For every store an aggregates file (goals_monitoring_<year>.aggregates.json) holds, per ISO week and per question, four
+running totals:
+    sum: the sum of all answers
+    answered: the number of answers given (not skipped)
+    targeted: the number of answers for which a target was set (t_<column> above 0)
+    attained: the number of those answers that reached their target
+Together with the number of records per week, these totals are all the report needs: means, rolling means, target
+attainment and skip rates are ratios of sums over one or more weeks. New records are added to the totals as they are
+stored, after a deletion only the weeks it touched are recomputed from the records. The totals are kept by column, so
+they are rebuilt from the records (in the current layout, see storage.py) once the survey content changes.
+
+"""
+import json
+import os
+from datetime import date
+from datetime import timedelta
+
+import lazy
+import storage
+
+np = lazy.module('numpy')
+pd = lazy.module('pandas')
+
+STATS = ['sum', 'answered', 'targeted', 'attained']
+
+
+def aggregates_path(stem):
+    return f'{stem}.aggregates.json'
+
+
+def _week_of(dates):
+    """Return the ISO week (e.g. 2022-W07) of each date."""
+    return pd.to_datetime(dates).dt.strftime('%G-W%V')
+
+
+def _week_start(week):
+    return date.fromisocalendar(int(week[:4]), int(week[6:]), 1)
+
+
+def compute_weeks(frame, plan):
+    """Compute the weekly totals of the records in a frame.
+
+    :param frame: The records, as read from the store.
+    :param plan: The compiled survey content, see schema.compile_plan.
+
+    :return: The totals per week: {week: {'records': n, 'columns': {column: [sum, answered, targeted, attained]}}}
+    :rtype: dict
+    """
+    if frame.empty:
+        return {}
+
+    weeks = _week_of(frame['date']).to_numpy()
+    columns = [column for column in plan.columns if column in frame]
+
+    # Step 1: Build all totals as columns of a single frame so they can be summed per week in one go.
+    totals = {'records': np.ones(len(frame))}
+    for column in columns:
+        values = frame[column].to_numpy(dtype=float)
+        answered = ~np.isnan(values)
+        target = frame[f't_{column}'].to_numpy(dtype=float) if f't_{column}' in frame else np.zeros(len(frame))
+        targeted = answered & (target > 0)
+
+        totals[f'{column}|sum'] = np.where(answered, values, 0)
+        totals[f'{column}|answered'] = answered
+        totals[f'{column}|targeted'] = targeted
+        totals[f'{column}|attained'] = targeted & (values >= target)
+
+    summed = pd.DataFrame(totals).groupby(weeks).sum()
+
+    # Step 2: Convert the sums to the nested structure stored on disk.
+    result = {}
+    for week, row in summed.iterrows():
+        result[week] = {'records': int(row['records']),
+                        'columns': {column: [float(row[f'{column}|{stat}']) for stat in STATS] for column in columns}}
+    return result
+
+
+def _record_weeks(record, plan):
+    """Compute the weekly totals of a single record as compute_weeks does, without building a frame."""
+    record_date = record['date'] if isinstance(record['date'], date) else date.fromisoformat(str(record['date'])[:10])
+    year, week, _ = record_date.isocalendar()
+
+    columns = {}
+    for column in plan.columns:
+        if column not in record:
+            continue
+        value = record[column]
+        answered = value is not None and value == value
+        target = record.get(f't_{column}') or 0
+        targeted = answered and target > 0
+        columns[column] = [float(value) if answered else 0.0, float(answered), float(targeted),
+                           float(targeted and value >= target)]
+
+    return {f'{year}-W{week:02d}': {'records': 1, 'columns': columns}}
+
+
+def _write(stem, weeks, plan):
+    temp_path = f'{aggregates_path(stem)}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as temp:
+        json.dump({'schema': plan.schema_hash, 'weeks': weeks}, temp)
+    os.replace(temp_path, aggregates_path(stem))
+
+
+def _rebuild(stem, plan):
+    weeks = compute_weeks(storage.read_records(stem), plan)
+    _write(stem, weeks, plan)
+    return weeks
+
+
+def rebuild(stem, plan):
+    """Recompute all aggregates of a store from its records."""
+    with storage.file_lock(storage.lock_path(stem, 'aggregates')):
+        return _rebuild(stem, plan)
+
+
+def _read(stem, plan):
+    """Read the aggregates of a store, None when they are missing or were built for another layout."""
+    try:
+        with open(aggregates_path(stem), encoding='utf-8') as file:
+            aggregates = json.load(file)
+        if aggregates.get('schema') == plan.schema_hash:
+            return aggregates['weeks']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    return None
+
+
+def _load(stem, plan):
+    weeks = _read(stem, plan)
+    return weeks if weeks is not None else _rebuild(stem, plan)
+
+
+def load(stem, plan):
+    """Load the aggregates of a store, they are built from the records the first time."""
+    with storage.file_lock(storage.lock_path(stem, 'aggregates')):
+        return _load(stem, plan)
+
+
+def _merge_into(weeks, additions):
+    for week, addition in additions.items():
+        current = weeks.setdefault(week, {'records': 0, 'columns': {}})
+        current['records'] += addition['records']
+        for column, stats in addition['columns'].items():
+            current['columns'][column] = [old + new for old, new in
+                                          zip(current['columns'].get(column, [0.0] * len(STATS)), stats)]
+
+
+def add_records(stem, frame, plan):
+    """Add newly stored records to the aggregates of a store, without reading any other record.
+
+    The aggregates file is locked while it is updated, so writers in other processes don't overwrite each other's
+    totals.
+    """
+    _add(stem, compute_weeks(frame, plan), plan)
+
+
+def _add(stem, additions, plan):
+    with storage.file_lock(storage.lock_path(stem, 'aggregates')):
+        # Rebuilding from the records includes the additions, which have been stored by now.
+        weeks = _read(stem, plan)
+        if weeks is None:
+            _rebuild(stem, plan)
+            return
+
+        _merge_into(weeks, additions)
+        _write(stem, weeks, plan)
+
+
+def add_record(stem, record, plan):
+    """Add a single newly stored record (a dictionary) to the aggregates of a store, see add_records."""
+    _add(stem, _record_weeks(record, plan), plan)
+
+
+def refresh(stem, plan, date_from=None, date_to=None):
+    """Recompute the weeks touched by a deletion.
+
+    Only the records of the full ISO weeks covering the date range are read again, and only the columns the totals
+    need. Without a date range (for instance after a deletion by condition) the aggregates are rebuilt entirely.
+    """
+    if not os.path.exists(aggregates_path(stem)) or (date_from is None and date_to is None):
+        rebuild(stem, plan)
+        return
+
+    with storage.file_lock(storage.lock_path(stem, 'aggregates')):
+        _refresh(stem, plan, date_from, date_to)
+
+
+def _refresh(stem, plan, date_from, date_to):
+    weeks = _load(stem, plan)
+
+    # Step 1: Widen the range to full weeks, the weeks on its edges also contain records outside of the range.
+    first = date.fromisoformat(date_from) if date_from else None
+    last = date.fromisoformat(date_to) if date_to else None
+    first_day = (first - timedelta(days=first.weekday())).isoformat() if first else ''
+    last_day = (last + timedelta(days=6 - last.weekday())).isoformat() if last else '9999'
+
+    # Step 2: Drop the affected weeks and add the records that remain in them again.
+    first_week = _week_of(pd.Series([first_day]))[0] if first else ''
+    last_week = _week_of(pd.Series([last_day]))[0] if last else '9999'
+    for week in [week for week in weeks if first_week <= week <= last_week]:
+        del weeks[week]
+
+    # Step 3: The date index shows whether any record is left in those weeks, when there is none nothing is read. Of
+    # the records that are, only the columns the totals are computed from are read.
+    dates = storage.date_index(stem)
+    dates = dates['date'].astype(str) if not dates.empty else pd.Series(dtype=str)
+    if ((dates >= first_day) & (dates <= last_day)).any():
+        columns = ['date'] + list(plan.columns) + list(plan.target_columns)
+        remaining = [chunk[(chunk['date'] >= first_day) & (chunk['date'] <= last_day)]
+                     for chunk in storage.scan_records(stem, columns)]
+        remaining = [chunk for chunk in remaining if not chunk.empty]
+        if remaining:
+            _merge_into(weeks, compute_weeks(pd.concat(remaining, axis=0, ignore_index=True), plan))
+
+    _write(stem, weeks, plan)
+
+
+def weekly_totals(stems, plan):
+    """Combine the aggregates of several stores into one frame with a row for every week in between the first and last
+    week, weeks without records hold zeros.
+
+    :return: A frame indexed by the first day of the week, with a records column and a <column>|<stat> column for every
+             question and total.
+    :rtype: Pandas DataFrame
+    """
+    weeks = {}
+    for stem in stems:
+        _merge_into(weeks, load(stem, plan))
+    if not weeks:
+        return pd.DataFrame()
+
+    rows = {}
+    for week, totals in weeks.items():
+        row = {'records': totals['records']}
+        for column, stats in totals['columns'].items():
+            row.update({f'{column}|{stat}': value for stat, value in zip(STATS, stats)})
+        rows[pd.Timestamp(_week_start(week))] = row
+
+    frame = pd.DataFrame.from_dict(rows, orient='index').sort_index()
+    return frame.reindex(pd.date_range(frame.index.min(), frame.index.max(), freq='W-MON'), fill_value=0).fillna(0)
+
+
+def build_report(stems, plan, weeks=12):
+    """Build the progress report for every question, grouped by sub goal.
+
+    For each of the last given number of weeks the report holds the mean answer of that week, the rolling 4 and 12
+    week means, the share of targets reached over the last 12 weeks and the share of records skipping the question
+    over the last 12 weeks.
+
+    :rtype: Pandas DataFrame
+    """
+    totals = weekly_totals(stems, plan)
+    if totals.empty:
+        return pd.DataFrame()
+
+    rolling_4 = totals.rolling(4, min_periods=1).sum()
+    rolling_12 = totals.rolling(12, min_periods=1).sum()
+
+    def ratio(numerator, denominator):
+        return (numerator / denominator.replace(0, np.nan)).round(2)
+
+    parts = []
+    for question in plan.questions:
+        column = question.column
+        if f'{column}|sum' not in totals:
+            continue
+        parts.append(pd.DataFrame({
+            'sub_goal': question.sub_goal_key,
+            'column': column,
+            'week': totals.index.strftime('%G-W%V'),
+            'mean': ratio(totals[f'{column}|sum'], totals[f'{column}|answered']),
+            'mean_4w': ratio(rolling_4[f'{column}|sum'], rolling_4[f'{column}|answered']),
+            'mean_12w': ratio(rolling_12[f'{column}|sum'], rolling_12[f'{column}|answered']),
+            'attainment_12w': ratio(rolling_12[f'{column}|attained'], rolling_12[f'{column}|targeted']),
+            'skip_rate_12w': ratio(rolling_12['records'] - rolling_12[f'{column}|answered'], rolling_12['records']),
+        }).iloc[-weeks:])
+
+    return pd.concat(parts, axis=0, ignore_index=True) if parts else pd.DataFrame()
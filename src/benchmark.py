@@ -0,0 +1,389 @@
+"""
+This document benchmarks the paths the program depends on, to make performance changes visible in review.
+
+Every benchmark runs offline on generated data in a temporary directory. The stores it works on are filled with a given
+number of existing records (1k, 100k and 1M by default), as the cost of most paths depends on the amount of history:
+    generate_test_data[n]: test mode, generating and writing n rows
+    generate_targets[n]: computing the targets of n records at once
+    survey_write[n]: storing the record of a survey in a store holding n records, as survey mode does (targets, log,
+                     aggregates and any merge this starts, see main.store_survey)
+    read_records[n]: reading a store holding n records
+    read_typed[n]: reading a store holding n records in the compact types of columnar.py
+    compact[n]: merging a full log into a store holding n records
+    delete[n]: deletion mode, deleting a date from a store holding n records and refreshing its aggregates
+    validate_response: validating scripted answers, a third of which is invalid and asked again
+    concurrent_append: 16 threads storing 100 records each into the same store
+    respondent_survey[r]: with r respondents holding 1k records each, one respondent storing a survey and querying
+                          their own records (the time should not depend on r)
+    compact_partitions: merging the logs of 8 respondent partitions with 4 processes
+
+Each benchmark is run a number of times, of which the fastest run is compared: slower runs mostly show interference by
+other processes rather than the code itself. The results are compared against a baseline file (JSON), any benchmark
+taking longer than the baseline by more than the threshold is reported as a regression and makes the run exit with
+status 1. Usage, from the src directory:
+
+    python benchmark.py --save                  run everything and store the results as the new baseline
+    python benchmark.py                         run everything and compare against the baseline
+    python benchmark.py --sizes 1000 --filter 'survey_*' --threshold 0.1
+
+Baselines are only comparable when recorded on the same machine, which is why the file records where it came from.
+
+"""
+import argparse
+import builtins
+import fnmatch
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+import journal
+import query
+import schema
+import storage
+import survey_content
+import synthetic_data
+import targets
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+RESPONDENT_COUNTS = [1, 100]
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# The first week of the generated stores, every store holds a single year of weekly dates.
+START_DATE = date(2026, 1, 5)
+
+# Scripted answers for validate_response per measurement level, each valid answer preceded by invalid ones.
+SCRIPTED_ANSWERS = {
+    'yes_no': ['maybe', 'Y', 'no'],
+    'likert_5': ['6', 'three', '4'],
+    'scale_10': ['11', '7.5', '0'],
+    'quantity': ['-1', '2.5', '12'],
+}
+
+
+def _fixture(directory, plan, rows):
+    """Generate a store holding the given number of records, with its index and aggregates."""
+    stem = storage.store_stem(START_DATE.year, directory)
+    frame = synthetic_data.generate_chunk(plan, np.random.default_rng(rows), 0, rows, skip_rate=0.1,
+                                          start_date=START_DATE)
+    frame['date'] = frame['date'].dt.strftime('%Y-%m-%d')
+    storage.replace_records(stem, targets.apply_targets(frame, survey_content))
+    aggregates.rebuild(stem, plan)
+    return stem
+
+
+def _partitioned_fixture(directory, plan, respondents, rows=1_000):
+    """Give every respondent a partition holding a store with the given number of records."""
+    frame = synthetic_data.generate_chunk(plan, np.random.default_rng(rows), 0, rows, skip_rate=0.1,
+                                          start_date=START_DATE)
+    frame['date'] = frame['date'].dt.strftime('%Y-%m-%d')
+    frame = targets.apply_targets(frame, survey_content)
+    for respondent in range(respondents):
+        stem = storage.store_stem(START_DATE.year, directory, respondent)
+        storage.replace_records(stem, frame.assign(respondent=respondent))
+        aggregates.rebuild(stem, plan)
+
+
+def _copy_store(template_stem, directory):
+    """Copy a generated store, so a benchmark changing it leaves the original intact for the next one. The modification
+    times are kept, as the index and columnar copy are tied to them."""
+    for path in glob.glob(f'{template_stem}.*'):
+        if not path.endswith('.lock'):
+            shutil.copy2(path, directory)
+    return os.path.join(directory, os.path.basename(template_stem))
+
+
+def _survey_record(plan):
+    record = schema.empty_record(plan, START_DATE)
+    record.update({column: 1 for column in plan.columns})
+    return record
+
+
+# Benchmarks. Each returns two functions: one preparing a repetition (not timed) and the repetition itself.
+
+def bench_generate_test_data(plan, directory, rows):
+    path = os.path.join(directory, 'TEST_DATA_goals_monitoring.csv')
+    return None, lambda: synthetic_data.generate_test_data(path, plan, rows=rows, seed=1, skip_rate=0.1)
+
+
+def bench_generate_targets(plan, directory, rows):
+    frame = synthetic_data.generate_chunk(plan, np.random.default_rng(1), 0, rows, skip_rate=0.1)
+    return None, lambda: targets.generate_targets(frame, survey_content)
+
+
+def _store_survey(plan, record, stem):
+    """Store a survey the way survey mode does (main.store_survey). The program doesn't exit before the threads it
+    started (such as a merge) are done, which is waited for as well."""
+    import main
+
+    running = set(threading.enumerate())
+    session = journal.Journal(None, plan, journal.TERMINAL_SESSION, str(record['date']))
+    main.store_survey(dict(record), stem, session, plan, survey_content)
+    for thread in set(threading.enumerate()) - running:
+        if not thread.daemon:
+            thread.join()
+
+
+def bench_survey_write(plan, stem):
+    record = _survey_record(plan)
+    return None, lambda: _store_survey(plan, record, stem)
+
+
+def bench_read_records(plan, stem):
+    return None, lambda: storage.read_records(stem)
+
+
+def bench_read_typed(plan, stem):
+    return None, lambda: storage.read_records(stem, typed=True)
+
+
+def bench_compact(plan, stem):
+    records = pd.DataFrame([_survey_record(plan)] * storage.COMPACT_THRESHOLD)
+    records['date'] = START_DATE.isoformat()
+    return lambda: storage.append_records(records, stem, merge=False), lambda: storage.compact(stem)
+
+
+def bench_delete(plan, stem):
+    day = START_DATE.isoformat()
+
+    def run():
+        storage.delete_records(stem, date_from=day, date_to=day)
+        aggregates.refresh(stem, plan, date_from=day, date_to=day)
+
+    return None, run
+
+
+def bench_validate_response(plan, directory, answers=30_000):
+    import main
+
+    levels = [question.measurement_level for question in plan.questions]
+    script = []
+    for position in range(answers // 3):
+        script.extend(SCRIPTED_ANSWERS[levels[position % len(levels)]])
+
+    def run():
+        answer = iter(script)
+        original_input = builtins.input
+        builtins.input = lambda prompt='': next(answer)
+        try:
+            for position in range(answers // 3):
+                main.validate_response(levels[position % len(levels)])
+        finally:
+            builtins.input = original_input
+
+    return None, run
+
+
+def bench_concurrent_append(plan, directory, threads=16, records=100):
+    stem = storage.store_stem(START_DATE.year, directory)
+    record = _survey_record(plan)
+
+    def write():
+        for _ in range(records):
+            storage.append_record(record, stem)
+
+    def run():
+        # Merges are left out, they would make the result depend on when the background threads happen to run.
+        threshold, storage.COMPACT_THRESHOLD = storage.COMPACT_THRESHOLD, sys.maxsize
+        try:
+            workers = [threading.Thread(target=write) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            storage.COMPACT_THRESHOLD = threshold
+
+    return None, run
+
+
+def bench_respondent_survey(plan, directory, respondents):
+    _partitioned_fixture(directory, plan, respondents)
+    stem = storage.store_stem(START_DATE.year, directory, 0)
+    record = dict(_survey_record(plan), respondent=0)
+
+    def run():
+        _store_survey(plan, record, stem)
+        query.read(query.open_dataset(directory, respondents=[0]), columns=['sg_1_*'])
+
+    return None, run
+
+
+def bench_compact_partitions(plan, directory, partitions=8, workers=4):
+    stems = [storage.store_stem(START_DATE.year, directory, partition) for partition in range(partitions)]
+    records = pd.DataFrame([_survey_record(plan)] * storage.COMPACT_THRESHOLD)
+    records['date'] = START_DATE.isoformat()
+
+    def prepare():
+        for stem in stems:
+            storage.append_records(records, stem, merge=False)
+
+    return prepare, lambda: storage.compact_stores(stems, workers)
+
+
+def _cases(sizes):
+    """List the benchmarks by name, along with whether they need a store of the given size to work on."""
+    cases = []
+    for rows in sizes:
+        cases.append((f'generate_test_data[{rows}]', bench_generate_test_data, rows, False))
+        cases.append((f'generate_targets[{rows}]', bench_generate_targets, rows, False))
+    for rows in sizes:
+        for name, benchmark in [('survey_write', bench_survey_write), ('read_records', bench_read_records),
+                                ('read_typed', bench_read_typed), ('compact', bench_compact), ('delete', bench_delete)]:
+            cases.append((f'{name}[{rows}]', benchmark, rows, True))
+    cases.append(('validate_response', bench_validate_response, None, False))
+    cases.append(('concurrent_append', bench_concurrent_append, None, False))
+    for respondents in RESPONDENT_COUNTS:
+        cases.append((f'respondent_survey[{respondents}]', bench_respondent_survey, respondents, False))
+    cases.append(('compact_partitions', bench_compact_partitions, None, False))
+    return cases
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=5, patterns=None):
+    """Run the benchmarks matching any of the patterns (all of them when None).
+
+    :return: The timings in seconds by benchmark: {name: {'median': s, 'min': s, 'repeat': n}}
+    :rtype: dict
+    """
+    plan = schema.compile_plan(survey_content)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as root:
+        templates = {}
+
+        for name, benchmark, rows, needs_store in _cases(sizes):
+            if patterns and not any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                continue
+
+            with tempfile.TemporaryDirectory(dir=root) as directory:
+                # Step 1: Prepare what the benchmark works on, generated stores are reused by the next benchmarks.
+                if needs_store:
+                    if rows not in templates:
+                        templates[rows] = _fixture(tempfile.mkdtemp(dir=root), plan, rows)
+                    prepare, run = benchmark(plan, _copy_store(templates[rows], directory))
+                elif rows is None:
+                    prepare, run = benchmark(plan, directory)
+                else:
+                    prepare, run = benchmark(plan, directory, rows)
+
+                # Step 2: Time every repetition separately, only the run itself counts.
+                timings = []
+                for _ in range(repeat):
+                    if prepare:
+                        prepare()
+                    start = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - start)
+
+            results[name] = {'median': statistics.median(timings), 'min': min(timings), 'repeat': repeat}
+            print(f'{name:<32}{results[name]["min"] * 1000:>12.2f} ms', flush=True)
+
+    return results
+
+
+def environment():
+    """Describe the machine and versions the results were recorded with."""
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'recorded': date.today().isoformat()}
+
+
+def compare(results, baseline, threshold):
+    """Compare the results against the baseline.
+
+    :param threshold: The allowed slowdown as a fraction of the baseline, e.g. 0.2 allows up to 20% slower.
+
+    :return: The comparison per benchmark, (name, current time, baseline time or None, change or None, regressed) for
+             every benchmark in the results, as well as the names of the regressed benchmarks. Times are the fastest
+             of the repetitions.
+    """
+    rows = []
+    regressions = []
+    for name, timing in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            rows.append((name, timing['min'], None, None, False))
+            continue
+        change = timing['min'] / previous['min'] - 1
+        regressed = change > threshold
+        rows.append((name, timing['min'], previous['min'], change, regressed))
+        if regressed:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_comparison(rows, threshold):
+    print(f'\n{"benchmark":<32}{"current":>12}{"baseline":>12}{"change":>10}')
+    for name, current, previous, change, regressed in rows:
+        previous_text = f'{previous * 1000:.2f}' if previous is not None else '-'
+        change_text = f'{change:+.1%}' if change is not None else 'new'
+        flag = f'  slower than allowed ({threshold:.0%})' if regressed else ''
+        print(f'{name:<32}{current * 1000:>12.2f}{previous_text:>12}{change_text:>10}{flag}')
+    print('(times in ms, fastest of all repetitions)')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark storage, generation, targets and validation.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='The baseline file (JSON) to compare against or to save to.')
+    parser.add_argument('--save', action='store_true',
+                        help='Store the results as the new baseline instead of comparing against it.')
+    parser.add_argument('--output',
+                        help='Also write the results of this run to a JSON file.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='The slowdown compared to the baseline, as a fraction, above which a benchmark counts as '
+                             'a regression.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='The numbers of existing records to run the size dependent benchmarks with.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='The number of times every benchmark is run.')
+    parser.add_argument('--filter', nargs='+',
+                        help="Only run the benchmarks matching any of these patterns, e.g. 'survey_*'.")
+    args = parser.parse_args()
+
+    # Step 1: Run the benchmarks.
+    results = run_benchmarks(args.sizes, args.repeat, args.filter)
+    report = {'environment': environment(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+    # Step 2: Either store the results as the baseline or compare them against it.
+    if args.save:
+        # Benchmarks that weren't run this time keep their previous baseline.
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as file:
+                report['results'] = dict(json.load(file).get('results', {}), **results)
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f'\nThe baseline is stored under {os.path.abspath(args.baseline)}')
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline found at {os.path.abspath(args.baseline)}, run with --save to create one.')
+        sys.exit(0)
+
+    with open(args.baseline, encoding='utf-8') as file:
+        baseline = json.load(file)
+
+    rows, regressions = compare(results, baseline, args.threshold)
+    print_comparison(rows, args.threshold)
+    if baseline.get('environment', {}).get('platform') != report['environment']['platform']:
+        print('Note: the baseline was recorded on a different platform, differences may not be caused by the code.')
+    if regressions:
+        print(f'\n{len(regressions)} benchmark(s) slowed down by more than {args.threshold:.0%}: '
+              f'{", ".join(regressions)}')
+        sys.exit(1)
@@ -0,0 +1,331 @@
+"""
+This document stores records in a compact, typed binary file to be memory-mapped (goals_monitoring_<year>.columns).
+
+The semicolon separated base file is easy to open anywhere, but reading it back means parsing text into float64 and
+object columns: every likert answer of 1 to 5 takes 8 bytes, and every date is a Python string. Next to the base file,
+storage.py keeps a copy of the same records in a columnar binary file. Each column is stored in the smallest type that
+holds its answers, with an explicit way of marking an answer as missing (the remaining questions of a sub goal are
+skipped after a no):
+    int: likert_5, quantity and target columns as int8 (or a larger integer when the values need it), the smallest
+         value of the type marks a missing answer
+    bits: yes_no answers packed 8 to a byte, with a second bit array marking which answers are present
+    date32: dates as the number of days since 1970-01-01 in an int32
+    float: scale_10 answers as float32 when that holds every value exactly, float64 otherwise, missing being NaN
+    dictionary: text columns (e.g. respondent names) as int32 codes into a list of values, -1 being missing
+A column is only stored in a smaller type when every value survives the round trip unchanged, otherwise a larger type is
+used. Data in the file never depends on the survey content being unchanged.
+
+The file starts with a JSON header describing the columns, followed by one block per column aligned to 64 bytes. The
+whole file is memory-mapped when opened: selecting columns or a range of rows creates views on the mapping, nothing is
+read from disk until the values are used. Columns can be turned into a DataFrame in two forms:
+    typed: the compact types as nullable pandas columns (Int8, Int32, Float32, categorical, datetime64)
+    plain: the same types a read_csv of the base file produces (float64 with NaN, ISO date strings)
+
+"""
+import json
+import os
+import struct
+
+import lazy
+
+np = lazy.module('numpy')
+pd = lazy.module('pandas')
+
+MAGIC = b'GOALCOLS'
+VERSION = 1
+ALIGNMENT = 64
+
+_INTEGER_TYPES = ['int8', 'int16', 'int32']
+_EPOCH = '1970-01-01'
+
+
+def _padding(position):
+    return -position % ALIGNMENT
+
+
+# Encoding
+
+def _integer_encoding(values):
+    """Return the smallest integer type that holds every value exactly, leaving its smallest value for missing."""
+    present = values[~np.isnan(values)]
+    if present.size and not np.array_equal(present, np.round(present)):
+        return None
+    low, high = (present.min(), present.max()) if present.size else (0, 0)
+
+    for dtype in _INTEGER_TYPES:
+        info = np.iinfo(dtype)
+        if info.min < low and high <= info.max:
+            return dtype
+    return None
+
+
+def _encode_numeric(values, dtype=None):
+    """Encode a numeric column, returning its description and blocks."""
+    values = values.astype('float64')
+    missing = np.isnan(values)
+
+    # Step 1: yes_no answers, bit-packed along with the bits marking which answers are present.
+    if dtype == 'bits' and np.isin(values[~missing], (0, 1)).all():
+        bits = np.packbits(np.where(missing, 0, values).astype('uint8'))
+        return {'encoding': 'bits'}, {'values': bits, 'valid': np.packbits(~missing)}
+
+    # Step 2: Whole numbers, in the smallest integer type that fits with a sentinel for missing values.
+    integer_type = _integer_encoding(values)
+    if integer_type is not None:
+        sentinel = np.iinfo(integer_type).min
+        return ({'encoding': 'int', 'dtype': integer_type, 'sentinel': int(sentinel)},
+                {'values': np.where(missing, sentinel, values).astype(integer_type)})
+
+    # Step 3: Other numbers, as float32 only when no value changes by it.
+    float_type = 'float32' if np.array_equal(values.astype('float32').astype('float64'), values, equal_nan=True) \
+        else 'float64'
+    return {'encoding': 'float', 'dtype': float_type}, {'values': values.astype(float_type)}
+
+
+def _encode_dates(series):
+    """Encode ISO formatted dates as date32, None when any value isn't a plain date. Only the distinct dates are
+    parsed, of which there are few."""
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    text = pd.Series(uniques, dtype=object).astype(str)
+    parsed = pd.to_datetime(text, format='%Y-%m-%d', errors='coerce')
+    if parsed.isna().any() or (parsed.dt.strftime('%Y-%m-%d') != text).any():
+        return None
+
+    sentinel = np.iinfo('int32').min
+    days = (parsed.to_numpy(dtype='datetime64[D]') - np.datetime64(_EPOCH, 'D')).astype('int64')
+    values = np.where(codes < 0, sentinel, days[codes] if len(days) else 0).astype('int32')
+    return {'encoding': 'date32', 'sentinel': int(sentinel)}, {'values': values}
+
+
+def _encode_dictionary(series):
+    codes, categories = pd.factorize(series.astype(object).where(series.notna()), use_na_sentinel=True)
+    return ({'encoding': 'dictionary', 'categories': [str(value) for value in categories]},
+            {'values': codes.astype('int32')})
+
+
+def encode(series, dtype=None):
+    """Encode a column, returning its description (for the header) and its blocks by name.
+
+    :param series: The column, as read from the base file or the log.
+    :param dtype: The type the measurement level prefers (see schema.LEVEL_DTYPES), or bits for yes_no answers. Only
+                  bits makes a difference: numbers are always stored in the smallest type holding them exactly.
+    """
+    if pd.api.types.is_bool_dtype(series.dtype):
+        series = series.astype('float64')
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return _encode_numeric(series.to_numpy(dtype='float64', na_value=np.nan), dtype)
+
+    if series.name == 'date':
+        encoded = _encode_dates(series)
+        if encoded is not None:
+            return encoded
+
+    # Text holding numbers only (e.g. read from a file without types) is still stored as numbers.
+    numbers = pd.to_numeric(series, errors='coerce')
+    if not (numbers.isna() & series.notna()).any() and \
+            (numbers.astype(str).where(series.notna()) == series.astype(str).where(series.notna())).all():
+        return _encode_numeric(numbers.to_numpy(dtype='float64'), dtype)
+
+    return _encode_dictionary(series)
+
+
+def write(path, frame, dtypes=None, signature=None, schema=None):
+    """Write a frame to a columnar file, replacing the file atomically.
+
+    :param path: The file to write.
+    :param frame: The records, its index is not stored.
+    :param dtypes: The preferred type of each column, see encode.
+    :param signature: Stored in the header, to tell whether the file still matches the file it was made from.
+    :param schema: Stored in the header, the hash of the layout of the records (see schema.layout_hash).
+    """
+    dtypes = dtypes or {}
+    columns = []
+    blocks = []
+    offset = 0
+
+    # Step 1: Encode every column and determine where its blocks will end up, relative to the first block.
+    for name in frame.columns:
+        description, column_blocks = encode(frame[name].rename(name), dtypes.get(name))
+        description.update(name=str(name), blocks={})
+        for block_name, block in column_blocks.items():
+            block = np.ascontiguousarray(block)
+            offset += _padding(offset)
+            description['blocks'][block_name] = [offset, block.dtype.str, int(block.size)]
+            blocks.append((offset, block))
+            offset += block.nbytes
+        columns.append(description)
+
+    header = json.dumps({'version': VERSION, 'signature': signature, 'schema': schema, 'rows': len(frame),
+                         'columns': columns}).encode('utf-8')
+    start = len(MAGIC) + 8 + len(header)
+    start += _padding(start)
+
+    # Step 2: Write the header followed by the blocks, next to the destination, and swap it in.
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as temp:
+        temp.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for block_offset, block in blocks:
+            temp.seek(start + block_offset)
+            temp.write(block.tobytes())
+        temp.truncate(start + offset)
+        temp.flush()
+        os.fsync(temp.fileno())
+    os.replace(temp_path, path)
+
+
+# Decoding
+
+def _values(description, blocks, rows, start=0, stop=None):
+    """Return the values of a column for a range of rows along with a mask of the missing values. For every encoding
+    except bits the values are a view on the blocks. Missing values hold the sentinel of the column (or NaN)."""
+    stop = rows if stop is None else min(stop, rows)
+
+    if description['encoding'] == 'bits':
+        values = np.unpackbits(blocks['values'], count=rows)[start:stop].view('int8')
+        missing = ~np.unpackbits(blocks['valid'], count=rows)[start:stop].astype(bool)
+        return values, missing
+
+    values = blocks['values'][start:stop]
+    if description['encoding'] == 'float':
+        return values, np.isnan(values)
+    if description['encoding'] == 'dictionary':
+        return values, values < 0
+    return values, values == description['sentinel']
+
+
+def _decode(description, values, missing, typed):
+    """Turn the values of a column into an array for a DataFrame, see ColumnFile.to_frame for typed."""
+    encoding = description['encoding']
+
+    if encoding == 'date32':
+        days = np.where(missing, np.datetime64('NaT'), values.astype('int64').astype('datetime64[D]'))
+        if typed:
+            return days.astype('datetime64[s]')
+        # Only a handful of distinct dates exist, formatting those is much faster than formatting every row.
+        unique, inverse = np.unique(days, return_inverse=True)
+        text = np.array([None if np.isnat(day) else str(day) for day in unique], dtype=object)
+        return text[inverse.reshape(-1)]
+
+    if encoding == 'dictionary':
+        if typed:
+            return pd.Categorical.from_codes(values, categories=description['categories'])
+        return np.array(description['categories'] + [None], dtype=object)[values]
+
+    if encoding == 'float':
+        if typed and values.dtype == np.float32:
+            return pd.arrays.FloatingArray(np.asarray(values), missing)
+        return values.astype('float64')
+
+    # Integers and bits, as the nullable integer type or as a read_csv would give them.
+    if typed:
+        return pd.arrays.IntegerArray(np.asarray(values), missing)
+    return np.where(missing, np.nan, values) if missing.any() else values.astype('int64')
+
+
+def read_header(path):
+    """Read the header of a columnar file, None when the file is missing or not a columnar file."""
+    try:
+        with open(path, 'rb') as file:
+            start = file.read(len(MAGIC) + 8)
+            if len(start) < len(MAGIC) + 8 or not start.startswith(MAGIC):
+                return None
+            header = json.loads(file.read(struct.unpack('<Q', start[len(MAGIC):])[0]))
+    except (FileNotFoundError, ValueError):
+        return None
+    return header if header.get('version') == VERSION else None
+
+
+class ColumnFile:
+    """A memory-mapped columnar file. Columns are returned as views on the mapping, without copying."""
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header or read_header(path)
+        if self.header is None:
+            raise ValueError(f'{path} is not a columnar file')
+
+        self._buffer = np.memmap(path, mode='r')
+        header_length = struct.unpack('<Q', bytes(self._buffer[len(MAGIC):len(MAGIC) + 8]))[0]
+        self._start = len(MAGIC) + 8 + header_length
+        self._start += _padding(self._start)
+        self._columns = {column['name']: column for column in self.header['columns']}
+
+    @property
+    def columns(self):
+        return [column['name'] for column in self.header['columns']]
+
+    @property
+    def rows(self):
+        return self.header['rows']
+
+    @property
+    def signature(self):
+        return self.header['signature']
+
+    @property
+    def schema(self):
+        return self.header.get('schema')
+
+    def encoding(self, name):
+        return self._columns[name]['encoding']
+
+    def block(self, name, block='values'):
+        """Return a block of a column as stored, a view on the mapped file."""
+        offset, dtype, size = self._columns[name]['blocks'][block]
+        start = self._start + offset
+        return self._buffer[start:start + size * np.dtype(dtype).itemsize].view(dtype)
+
+    def values(self, name, start=0, stop=None):
+        """Return the stored values of a column for a range of rows, along with a mask of the missing values.
+
+        For every encoding except bits the values are a view on the mapped file, nothing is copied. Missing values hold
+        the sentinel of the column (or NaN), they are only meaningful together with the mask.
+        """
+        column = self._columns[name]
+        blocks = {block: self.block(name, block) for block in column['blocks']}
+        return _values(column, blocks, self.rows, start, stop)
+
+    def column(self, name, start=0, stop=None, typed=True):
+        """Return a column as an array for a DataFrame, see to_frame for the difference between typed and plain."""
+        return _decode(self._columns[name], *self.values(name, start, stop), typed)
+
+    def to_frame(self, columns=None, start=0, stop=None, typed=False):
+        """Decode a range of rows of the given columns into a DataFrame.
+
+        :param columns: The columns to decode, None for all columns. Columns that aren't stored are left out.
+        :param start: The first row.
+        :param stop: The row after the last row, None for the end of the file.
+        :param typed: Whether to keep the compact types (nullable Int8, Float32, categorical and datetime64 columns)
+                      or decode to the types a read_csv of the base file gives (float64 with NaN, date strings).
+
+        :rtype: Pandas DataFrame
+        """
+        columns = self.columns if columns is None else [column for column in columns if column in self._columns]
+        stop = self.rows if stop is None else min(stop, self.rows)
+        return pd.DataFrame({name: self.column(name, start, stop, typed) for name in columns},
+                            index=pd.RangeIndex(start, stop), columns=columns)
+
+
+def open_file(path, signature=None):
+    """Open a columnar file, None when it is missing or was made from a different version of the records.
+
+    :param signature: When given, the signature the file has to hold.
+
+    :rtype: ColumnFile or None
+    """
+    header = read_header(path)
+    if header is None or (signature is not None and header['signature'] != signature):
+        return None
+    return ColumnFile(path, header)
+
+
+def to_typed(frame, dtypes=None):
+    """Convert a frame as read from the base file or the log to the compact types, as to_frame(typed=True) gives.
+
+    :param dtypes: The preferred type of each column, see encode.
+    """
+    columns = {}
+    for name in frame.columns:
+        description, blocks = encode(frame[name].rename(name), (dtypes or {}).get(name))
+        columns[name] = _decode(description, *_values(description, blocks, len(frame)), typed=True)
+    return pd.DataFrame(columns, index=frame.index, columns=frame.columns)
@@ -0,0 +1,202 @@
+"""
+This document imports survey responses in bulk (import mode), for instance from a form exporting CSV or JSONL files.
+
+The responses are read in chunks and every chunk is validated column by column, applying the rules of validation.py
+to whole columns at once. Besides yes and no, 1 and 0 (or true and false) are accepted for yes_no questions. An answer
+of 0 means the question was skipped. Just like prompt_questions does, the skipped question and the remaining questions
+of its sub goal are left empty, unless it is an element of a nested question or a general goal.
+
+A respondent column is optional, each record with a respondent is stored in the partition of that respondent (see
+storage.py).
+
+Rows containing an invalid answer, date or respondent are not imported but written to a side file, together with the
+reason they were rejected. Chunks can be validated in a process pool, the accepted rows are stored in the order they
+were read.
+
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+import storage
+import targets
+import validation
+
+# Forms commonly export yes/no questions as 1 and 0, or as true and false (JSON booleans), these are accepted next to
+# the answers validation.py accepts.
+YES_NO_VALUES = dict(validation.YES_NO_VALUES, **{'1': 1, '1.0': 1, '0': 0, '0.0': 0, 'true': 1, 'false': 0})
+
+
+def read_chunks(path, chunk_size=100_000, sep=','):
+    """Read a CSV or JSONL (by the .json/.jsonl extension) file in chunks, all values are kept as read."""
+    if os.path.splitext(path)[1].lower() in ('.json', '.jsonl'):
+        return pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False, convert_dates=False)
+    return pd.read_csv(path, sep=sep, chunksize=chunk_size, dtype=str, skipinitialspace=True)
+
+
+def _reject(reasons, invalid, message):
+    """Record the reason for every row that is invalid and has not been rejected for an earlier reason yet."""
+    reasons[invalid & (reasons == '')] = message
+
+
+def validate_chunk(chunk, plan):
+    """Validate and convert a chunk of raw responses.
+
+    :param chunk: The responses as read, one row per record. Columns that aren't part of the plan are ignored,
+                  question columns that are missing are treated as unanswered.
+    :param plan: The compiled survey content, see schema.compile_plan.
+
+    :return: The accepted records (date, respondent when given, and question columns) and the rejected rows with a
+             reason column.
+    :rtype: tuple of Pandas DataFrames
+    """
+    if 'date' not in chunk:
+        raise ValueError("The responses don't contain a date column.")
+
+    reasons = np.full(len(chunk), '', dtype=object)
+    records = {}
+
+    # Step 1: Dates must be parseable, they are stored in ISO format. A respondent, when given, decides the partition
+    # the record is stored in and has to be a valid id (see storage.RESPONDENT_ID).
+    dates = pd.to_datetime(chunk['date'], errors='coerce')
+    _reject(reasons, dates.isna().to_numpy(), 'date: not a valid date')
+    records['date'] = dates.dt.strftime('%Y-%m-%d')
+
+    if 'respondent' in chunk:
+        respondents = chunk['respondent'].astype(str).str.strip().where(chunk['respondent'].notna(), '')
+        invalid = (respondents != '') & ~respondents.str.match(storage.RESPONDENT_ID.pattern)
+        _reject(reasons, invalid.to_numpy(), 'respondent: not a valid respondent id')
+        records['respondent'] = respondents.where(respondents != '', None)
+
+    # Step 2: Each column is validated according to its measurement level, NaN means no answer was given.
+    for question in plan.questions:
+        column, level = question.column, question.measurement_level
+        if column not in chunk:
+            records[column] = np.full(len(chunk), np.nan)
+            continue
+
+        raw = chunk[column]
+        given = raw.notna().to_numpy() & (raw.astype(str).str.strip() != '').to_numpy()
+
+        if level == 'yes_no':
+            values = raw.astype(str).str.strip().str.lower().map(YES_NO_VALUES).to_numpy(dtype=float, copy=True)
+            _reject(reasons, given & np.isnan(values), f'{column}: not a yes or no answer')
+        else:
+            low, high, integer = validation.NUMERIC_RULES[level]
+            values = pd.to_numeric(raw, errors='coerce').to_numpy(dtype=float, copy=True)
+            with np.errstate(invalid='ignore'):
+                invalid = np.isnan(values) | (values < low) | (values > high)
+                if integer:
+                    invalid |= values % 1 != 0
+            _reject(reasons, given & invalid, f'{column}: not a valid {level} answer')
+
+        values[~given] = np.nan
+        records[column] = values
+
+    # Step 3: Apply the skip logic of prompt_questions, a 0 empties the rest of its sub goal.
+    skipped = {}
+    for question in plan.questions:
+        if question.nested_in is not None or question.sub_goal_key == 'gnrl':
+            continue
+        column = question.column
+        sub_goal_skipped = skipped.get(question.sub_goal_key, np.zeros(len(chunk), dtype=bool)) | \
+            (records[column] == 0)
+        skipped[question.sub_goal_key] = sub_goal_skipped
+        records[column] = np.where(sub_goal_skipped, np.nan, records[column])
+
+    records = pd.DataFrame(records, index=chunk.index)
+    accepted = reasons == ''
+
+    rejected = chunk[~accepted].copy()
+    rejected['reason'] = reasons[~accepted]
+
+    return records[accepted], rejected
+
+
+def _validated_chunks(chunks, plan, workers):
+    """Validate the chunks, in a process pool when more than one worker is requested. The chunks are yielded in the
+    order they were read and only a limited number of them is kept in memory at once."""
+    if workers <= 1:
+        for chunk in chunks:
+            yield validate_chunk(chunk, plan)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(validate_chunk, chunk, plan))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def store_results(results, plan, directory='.', merge=True):
+    """Store records (with their targets) in the store of the year they are dated in and add them to its aggregates.
+    Records of a respondent go to the partition of that respondent, see storage.partition_directory.
+
+    :param results: The records, one row per record with the date as an ISO formatted string.
+    :param plan: The compiled survey content, see schema.compile_plan.
+    :param merge: Whether a background merge may be started, see storage.append_records.
+
+    :return: The stores that received records.
+    :rtype: list
+    """
+    if 'respondent' in results:
+        respondents = results['respondent'].astype(str).where(results['respondent'].notna(), '')
+    else:
+        respondents = pd.Series('', index=results.index)
+
+    stems = []
+    for (year, respondent), records in results.groupby([results['date'].str[:4], respondents], sort=False):
+        stem = storage.store_stem(year, directory, respondent or None)
+        if not respondent:
+            records = records.drop(columns='respondent', errors='ignore')
+        storage.append_records(records, stem, merge=merge)
+        aggregates.add_records(stem, records, plan)
+        stems.append(stem)
+    return stems
+
+
+def import_responses(path, plan, content, directory='.', sep=',', chunk_size=100_000, workers=1):
+    """Import a file of responses into the yearly stores.
+
+    Accepted records get their targets generated and are appended to the store of the year (and respondent) they
+    belong to. Every store that received records is merged once all responses have been read. Rejected rows are
+    written to <path without extension>.rejected.csv, separated by sep like the input.
+
+    :param path: The CSV or JSONL file to import.
+    :param sep: The separator of a CSV file.
+    :param plan: The compiled survey content, see schema.compile_plan.
+    :param content: a .py file containing all goals, questions and target rules.
+    :param workers: The number of processes validating chunks and merging the stores afterwards, 1 does all of it in
+                    the current process.
+
+    :return: The number of accepted and rejected rows.
+    :rtype: tuple
+    """
+    rejected_path = f'{os.path.splitext(path)[0]}.rejected.csv'
+    accepted_count = rejected_count = 0
+    stems = set()
+
+    if os.path.exists(rejected_path):
+        os.remove(rejected_path)
+
+    for accepted, rejected in _validated_chunks(read_chunks(path, chunk_size, sep), plan, workers):
+        results = pd.concat([accepted, targets.generate_targets(accepted, content)], axis=1)
+
+        stems.update(store_results(results, plan, directory, merge=False))
+
+        if not rejected.empty:
+            rejected.to_csv(rejected_path, sep=sep, mode='a', index=False, header=rejected_count == 0)
+
+        accepted_count += len(accepted)
+        rejected_count += len(rejected)
+
+    storage.compact_stores(sorted(stems), workers)
+
+    return accepted_count, rejected_count
@@ -0,0 +1,194 @@
+"""
+This document keeps a journal of the answers given in a survey session, so an interrupted survey can be resumed.
+
+Every answer is appended to the journal of its session as soon as it is accepted, as a line of JSON:
+
+    {"session": "survey", "key": "5f0c8e...", "date": "2026-10-12", "respondent": null, "_schema": "0ca651603fd63db3"}
+    {"column": "sg_1_1_1", "answer": 4}
+    {"column": "sg_1_1_2", "answer": 0}
+
+The first line describes the session and holds a random key, unique to this attempt at the survey. Every further line
+holds a single answer. Lines are only ever appended and each is handed to the operating system right away, without
+waiting for the disk: an answer costs one small write and survives the program being interrupted or killed, or the
+terminal being closed. The journal is opened for every answer and closed right after, so open sessions (of which the
+survey server can have many) don't hold on to a file each. A line cut off halfway is ignored.
+
+When the session is opened again, the answers of its journal are sent into the walk over the questions (see
+schema.walk) in the order they were given. This brings the walk to the first question without an answer, skipping the
+same sub goals as before. A journal written for different survey content is thrown away and the survey starts over.
+
+Once the last question is answered, the record is built from the answers and stored along with the key of the journal
+(see storage.append_record). Only then is the journal removed. When the program stops in between, the next time the
+session is opened the record is found in the store: the journal is removed and the aggregates of its week are
+recomputed, so a record is stored exactly once.
+
+Journals are kept next to the stores of the respondent, as goals_monitoring.<session>.journal. The survey mode uses the
+session id 'survey', the survey server the id of each of its sessions.
+
+"""
+import glob
+import json
+import os
+import uuid
+
+import aggregates
+import schema
+import storage
+
+# The session id of the survey mode, a respondent answers one survey at a time in the terminal.
+TERMINAL_SESSION = 'survey'
+
+
+def journal_path(session, directory='.', respondent=None):
+    """Return the path of the journal of a session, in the partition of the respondent (see storage.py)."""
+    return os.path.join(storage.partition_directory(respondent, directory), f'goals_monitoring.{session}.journal')
+
+
+def list_journals(directory='.'):
+    """Return the paths of all journals in the directory and the partitions of its respondents."""
+    directory = glob.escape(directory)
+    return sorted(glob.glob(os.path.join(directory, 'goals_monitoring.*.journal')) +
+                  glob.glob(os.path.join(directory, storage.PARTITIONS_DIRECTORY, '*', 'goals_monitoring.*.journal')))
+
+
+def replay(plan, answers):
+    """Walk through the questions of the plan (see schema.walk), answering them with the answers of a journal.
+
+    :param answers: (column, answer) tuples, in the order in which they were given.
+
+    :return: The walk, the first question without an answer and the responses by column. The question is None once
+             every question is answered, the responses are None until then.
+    :rtype: tuple
+    :raises ValueError: When the answers don't follow the walk.
+    """
+    steps = schema.walk(plan)
+    question = next(steps)
+    for position, (column, answer) in enumerate(answers):
+        if question is None or question.column != column:
+            raise ValueError(f'Answer {position + 1} of the journal is for {column}, not for the question asked.')
+        try:
+            question = steps.send(answer)
+        except StopIteration as walk_done:
+            question = None
+            responses = walk_done.value or {}
+    return steps, question, responses if question is None else None
+
+
+class Journal:
+    """The answers of a single session along with the walk over its questions: question is the question to answer
+    next and becomes None once the survey is completed, after which responses holds the answers by column. key
+    identifies the record of the session in the store. Without a path, the answers are kept in memory only."""
+
+    def __init__(self, path, plan, session, record_date, respondent=None, answers=(), key=None):
+        self.path = path
+        self.plan = plan
+        self.session = session
+        self.key = key or uuid.uuid4().hex
+        self.date = record_date
+        self.respondent = respondent
+        self.answers = list(answers)
+        self.steps, self.question, self.responses = replay(plan, self.answers)
+
+    def answer(self, response):
+        """Journal the (validated) response to the current question and move on.
+
+        :return: The next question, None once every question is answered.
+        """
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                if file.tell() == 0:
+                    file.write(json.dumps({'session': self.session, 'key': self.key, 'date': self.date,
+                                           'respondent': self.respondent,
+                                           storage.SCHEMA_KEY: self.plan.schema_hash}) + '\n')
+                file.write(json.dumps({'column': self.question.column, 'answer': response}) + '\n')
+
+        self.answers.append((self.question.column, response))
+        try:
+            self.question = self.steps.send(response)
+        except StopIteration as walk_done:
+            self.question, self.responses = None, walk_done.value or {}
+        return self.question
+
+    def record(self):
+        """Return the record of the completed survey, without its targets."""
+        record = schema.empty_record(self.plan, self.date, self.respondent)
+        record.update(self.responses)
+        return record
+
+    def discard(self):
+        """Remove the journal, once its record has been stored or the session is abandoned."""
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def _read(path):
+    """Read a journal, removing a line cut off halfway.
+
+    :return: The first line and the (column, answer) tuples, None when there is no journal or it can't be read.
+    :rtype: tuple
+    """
+    try:
+        with open(path, 'rb+') as file:
+            content = file.read()
+            if not content.endswith(b'\n'):
+                content = content[:content.rfind(b'\n') + 1]
+                file.truncate(len(content))
+    except FileNotFoundError:
+        return None
+
+    try:
+        lines = [json.loads(line) for line in content.decode('utf-8').splitlines()]
+        answers = [(line['column'], line['answer']) for line in lines[1:]]
+    except (ValueError, KeyError, TypeError):
+        return None
+    return (lines[0], answers) if lines and isinstance(lines[0], dict) else None
+
+
+def load_journal(path, plan, directory='.'):
+    """Resume the session of a journal.
+
+    A journal that can't be resumed is removed: one that can't be read, was written for different survey content or
+    of which the record has been stored already. In the last case the aggregates of the week of the record are
+    recomputed, in case the session stopped before adding the record to them.
+
+    :param directory: The directory holding the stores, see storage.py.
+
+    :return: The journal, None when there is nothing to resume.
+    :rtype: Journal
+    """
+    content = _read(path)
+    journal = None
+    if content is not None and content[0].get(storage.SCHEMA_KEY) == plan.schema_hash:
+        header, answers = content
+        try:
+            journal = Journal(path, plan, header['session'], header['date'], header['respondent'], answers,
+                              header['key'])
+        except (KeyError, ValueError):
+            pass
+    if journal is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+
+    stem = storage.store_stem(journal.date[:4], directory, journal.respondent)
+    if storage.session_stored(stem, journal.key):
+        aggregates.refresh(stem, plan, journal.date, journal.date)
+        journal.discard()
+        return None
+    return journal
+
+
+def open_journal(plan, session, record_date, directory='.', respondent=None):
+    """Open the journal of a session, resuming it when an earlier attempt was interrupted.
+
+    :param session: The id of the session, TERMINAL_SESSION for the survey mode.
+    :param record_date: The date (YYYY-MM-DD) of the record, a resumed session keeps the date it was started on.
+
+    :rtype: Journal
+    """
+    path = journal_path(session, directory, respondent)
+    return load_journal(path, plan, directory) or Journal(path, plan, session, record_date, respondent)
@@ -0,0 +1,46 @@
+"""
+This document defers importing heavy dependencies until they are actually used.
+
+Importing pandas and numpy takes several tenths of a second, most of the time it takes the program to start. Modules
+on the path of the survey mode (storage.py, targets.py and aggregates.py) only need them for reading and merging the
+store, not for asking the questions and appending a record. These modules refer to a stand-in instead:
+
+    pd = lazy.module('pandas')
+
+The real module is imported the first time any of its attributes is used, e.g. pd.DataFrame. Importing goes through
+importlib, which takes care of threads using the module for the first time at the same moment.
+
+"""
+import importlib
+
+
+class LazyModule:
+    """Stand-in for a module, which imports the module on first use and forwards every attribute to it."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}' ({'imported' if self._module is not None else 'not imported'})>"
+
+
+def module(name):
+    """Return a stand-in for the module with the given name, see LazyModule."""
+    return LazyModule(name)
+
+
+def load(stand_in):
+    """Import the module behind a stand-in right away.
+
+    Threads that may still be running while the program exits (such as a merge in the background) can't import
+    anything by then, the modules they use are loaded before such a thread is started.
+    """
+    if stand_in._module is None:
+        stand_in._module = importlib.import_module(stand_in._name)
+    return stand_in._module
@@ -1,19 +1,35 @@
-import os
 import sys
-import argparse
-import enquiries
-import random
 
-import numpy as np
-import pandas as pd
+# Profiling has to start before anything else is imported, to include those imports in the report.
+import startup
+if '--profile-startup' in sys.argv:
+    startup.enable()
+
+import os
+import argparse
+import time
 from datetime import date
-from datetime import timedelta
 
+import metrics
+import schema
+import validation
 import survey_content
 
+# Heavier modules (pandas through most of the modules below, enquiries) are imported by the modes that need them, so
+# the survey starts without waiting for them.
+
+# The number of dates shown at once when choosing a record to delete.
+PAGE_SIZE = 15
+
+
+def start_survey(weekly_entry_dict, goals_questions, respondent=None, session=None):
+    """Initialize the survey and start the method calls.
 
-def start_survey(weekly_entry_dict, goals_questions):
-    """Initialize the survey and start the method calls."""
+    :param respondent: The id of the respondent taking the survey, whose answers are stored in a partition of their
+                       own. None keeps them in the stores of the working directory.
+    :param session: The journal of the survey (see journal.py), which holds the answers of an interrupted attempt.
+    """
+    import storage
 
     # Step 1: Print welcome message:
     print("\n"
@@ -23,31 +39,74 @@ def start_survey(weekly_entry_dict, goals_questions):
           "=========================================================================================================\n"
           "---------------------------------------------------------------------------------------------------------\n"
           "\n"
-          "At any time, press ctrl+c to exit the program. Your data will not be stored and next time, you will start\n"
-          " with a clean slate. If a question doesn't apply to what you have done this week, please enter a 0. For \n"
-          "questions that accept a float entry, please denote it as such: #.#.\n\n"
+          "At any time, press ctrl+c to exit the program. Your answers so far are kept and next time, the survey will\n"
+          " continue where you left off. If a question doesn't apply to what you have done this week, please enter a\n"
+          " 0. For questions that accept a float entry, please denote it as such: #.#.\n\n"
 
           "Let's get started with the survey:\n\n"
           "---------------------------------------------------------------------------------------------------------\n"
           f"----------------------- End of Week Goal Progression Survey: Week {date.today().strftime('%V')}, {date.today().strftime('%Y')} ------------------------------\n"
           "---------------------------------------------------------------------------------------------------------\n")
 
+    if respondent is not None:
+        print(f"Answering as respondent {respondent}.\n")
+    if session is not None and session.answers:
+        print(f"Welcome back! The {len(session.answers)} answer(s) you gave on {session.date} have been kept, the "
+              "survey continues with the first question you haven't answered yet.\n")
+
     # Step 2: Start prompting all the questions (main method of the document).
-    response_dict = prompt_questions(weekly_entry_dict, goals_questions)
+    with metrics.span('survey.questions'):
+        response_dict = prompt_questions(weekly_entry_dict, goals_questions, session)
 
     # Step 3: Print thank you message, concluding the survey and letting the responded know where there answers are
     # stored
+    stem = storage.store_stem(str(weekly_entry_dict['date'])[:4], respondent=respondent)
     print("\n"
           "---------------------------------------------------------------------------------------------------------\n"
           "---------------------- This is the end of the survey, thank you for taking part ! -----------------------\n"
           "---------------------------------------------------------------------------------------------------------\n"
-          f"\nYour answers have been stored, recorded and can be found under:\n {os.getcwd()}/goals_monitoring"
-          f"{today.strftime('%Y')}.csv\n")
+          f"\nYour answers have been stored, recorded and can be found under:\n "
+          f"{os.path.abspath(storage.log_path(stem))}\n"
+          f"\nThey are added to {os.path.abspath(storage.base_path(stem))} the next time the log is merged.\n")
+
+    return response_dict
+
+
+def store_survey(survey_results, stem, session, plan, content):
+    """Store the record of a completed survey, the way survey mode does once the last question is answered.
+
+    :param survey_results: The record of the survey, without its targets.
+    :param stem: The store of the record, as returned by storage.store_stem.
+    :param session: The journal of the survey, which is removed once the record is stored.
+    :param plan: The compiled survey content, see schema.compile_plan.
+    :param content: a .py file containing all goals, questions and target rules.
+
+    :return: The background merge started by storing the record, None if the log didn't need one yet.
+    """
+    import aggregates
+    import storage
+    import targets
 
-    return pd.DataFrame(response_dict, index=[0])
+    # Step 1: Generate targets for relevant questions, as defined in the content.
+    with metrics.span('survey.targets'):
+        survey_results.update(targets.record_targets(survey_results, content))
 
+    # Step 2: Store results by appending them to the log of this year's store (of the respondent), the existing records
+    # are not read. The record is written in a single line along with the key of the journal.
+    with metrics.span('survey.store'):
+        merge = storage.append_record(survey_results, stem, session.key)
 
-def prompt_questions(storage_dict, content):
+    # Step 3: Add the results to the weekly aggregates used by the report mode.
+    with metrics.span('survey.aggregates'):
+        aggregates.add_record(stem, survey_results, plan)
+
+    # Step 4: The record is stored, the journal is no longer needed. Had the program stopped before this point, the
+    # next survey would have found the record in the store and finished up here (see journal.load_journal).
+    session.discard()
+    return merge
+
+
+def prompt_questions(storage_dict, content, session=None):
     """Prompt questions to respondent, record valid answers.
 
     This method prompts questions from the .py file referenced in the content argument. It follows a structure of:
@@ -63,290 +122,413 @@ def prompt_questions(storage_dict, content):
 
     :param storage_dict: A dictionary thich eventually will contain a response for each question id
     :param content: a .py file containing all goals and questions.
+    :param session: The journal (see journal.py) every answer is written to as soon as it is given. When resuming, the
+                    questions it holds answers to are not asked again. None keeps the answers in memory only.
 
     :return: Nothing, the provided dictionary is being mutated.
     """
-    # Step 1: Welcome respondent to the start of the survey by printing the first overarching goal.
-    print("You have set 2 overarching goals this year. Let's reflect on each of "
+    # Step 1: Welcome respondent to the start of the survey. The questions are taken from the compiled plan, which
+    # lists them in the order in which they are asked, along with the goal and sub goal they belong to.
+    plan = schema.compile_plan(content)
+    print(f"You have set {len(content.overarching_goals)} overarching goals this year. Let's reflect on each of "
           "them and their sub goals.\n")
 
-    for i, goal in enumerate(content.overarching_goals):
+    # The walk over the plan (kept by the journal) yields every question that has to be asked and takes care of
+    # skipping the remainder of a sub goal once a question is answered with no (or 0).
+    if session is None:
+        import journal
+        session = journal.Journal(None, plan, None, storage_dict['date'])
+    current_goal = current_sub_goal = current_nested = None
+
+    question = session.question
+    startup.mark('first question')
+    while question is not None:
+
+        if question.goal_number != current_goal and question.goal is not None:
+            current_goal = question.goal_number
+            if current_goal == 1:
+                print(f"Let's first take a look at overarching goal number 1:\n")
+            else:
+                print(f"\nNext up is overarching goal number {current_goal}\n")
+            print("--  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --")
+            print(f"\nGoal #{current_goal}:\n{question.goal}\n")
 
-        if i == 0:
-            print(f"Let's first take a look at overarching goal number 1:\n")
+            # Step 2: Once the overarching goal is printed, a count is given for the number of sub goals.
+            print(f"For this goal {len(content.sub_goals[f'og_{current_goal}'])} sub goals have been defined, "
+                  "you will reflect on each of them.\n")
             print("--  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --")
-            print(f"\nGoal #{i + 1}:\n{goal}\n")
+
+        if question.sub_goal_key == 'gnrl':
+            # Step 5: Lastly, general goals are printed and recorded individually.
+            if current_sub_goal != 'gnrl':
+                current_sub_goal = 'gnrl'
+                print("\nLastly, there are some general goals to reflect on:")
+            print(f"\nGeneral goal #{question.sub_goal_number}/{len(content.sub_goals['gnrl'])}: "
+                  f"{question.sub_goal}\n")
+            print(question.text + '\n')
+
         else:
-            print(f"\nNext up is overarching goal number {i + 1}\n")
-            print("--  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --")
-            print(f"\nGoal #{i + 1}:\n{goal}\n")
-
-        # Step 2: Once the overarching goal is printed, a count is given for the number of sub goals.
-        print(f"For this goal {len(content.sub_goals[f'og_{i + 1}'])} sub goals have been defined, "
-              "you will reflect on each of them.\n")
-        print("--  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --  --")
-
-        for j, sg in enumerate(content.sub_goals[f'og_{i + 1}']):
-            # Step 3: Each sub goal is printed
-            print(f'\nSub goal {i + 1}.{j + 1}: {sg}')
-
-            for k, question in enumerate(content.questions_by_subgoals[f'og_{i + 1}_{j + 1}']):
-                # Step 4: For each sub goal, we print the relevant questions.
-                print('\n' + question[0])
-                # Step 4a: An exception is made for the nested measurement level, the slightly different structure
-                # demands a difference in logic. in actually asking the question and recording the answer given by the
-                # respondent.
-                if question[1] == 'nested':
-                    for element in question[2]:
-                        print('\n - ' + element[0])
-                        response = validate_response(element[1])
-                        storage_dict[f'sg_{i + 1}_{j + 1}_{k + 1}_{element[0].lower()}'] = response
-                else:
-                    # Step 4b: For the other questions we question the response directly and store it in the storage
-                    # dictionary under a key identifiable by the order of goals_sub goals_questions.
-                    response = validate_response(question[1])
-                    if response in ('n', 'no', 0):
-                        break
-                    storage_dict[f'sg_{i + 1}_{j + 1}_{k + 1}'] = response
-
-    # Step 5: Lastly, general goals are printed and recorded individually, for each goal the fourth general question
-    # is all that is desired to know.
-    print("\nLastly, there are some general goals to reflect on:")
-    question = content.general_questions[3]
-
-    for i, goal in enumerate(content.sub_goals['gnrl']):
-        print(f"\nGeneral goal #{i+1}/{len(content.sub_goals['gnrl'])}: {goal}\n")
-        print(question[0] + '\n')
-        response = validate_response(question[1])
-
-        storage_dict[f'gnrl_{i + 1}'] = response
+            if question.sub_goal_key != current_sub_goal:
+                # Step 3: Each sub goal is printed
+                current_sub_goal = question.sub_goal_key
+                print(f'\nSub goal {question.goal_number}.{question.sub_goal_number}: {question.sub_goal}')
+
+            # Step 4: For each sub goal, we print the relevant questions. An exception is made for the nested
+            # measurement level, the question is printed once after which each of its elements is asked.
+            if question.nested_in is not None:
+                if question.nested_in != current_nested:
+                    current_nested = question.nested_in
+                    print('\n' + question.nested_in)
+                print('\n - ' + question.text)
+            else:
+                current_nested = None
+                print('\n' + question.text)
+
+        # Every valid answer is journaled before moving on to the next question.
+        question = session.answer(validate_response(question.measurement_level, question.column))
+
+    # Step 6: Once every question has been asked, the responses are stored in the storage dictionary under a key
+    # identifiable by the order of goals_sub goals_questions.
+    storage_dict.update(session.responses)
 
     return storage_dict
 
 
-def validate_response(measurement_level):
+def validate_response(measurement_level, column=None):
     """Validate responses entered by the respondent.
 
     This method takes the question as it comes from the content object and after it is posed to the respondent by the
-    prompt_questions method. After the question is posed, this method will check for the accompanying measurement level
-    and answer the correct question accordingly. It will do until an acceptable response is given. -1000 and an empty
-    string are used as defaults in order for the while loops to be able to run. yes_no responses are transformed to
-    1 | 0.
+    prompt_questions method. After the question is posed, this method will ask for an answer matching the accompanying
+    measurement level. It will do until an acceptable response is given, the rules for each measurement level can be
+    found in validation.py. yes_no responses are transformed to 1 | 0.
 
-    :param measurement_level: A question represented as a list with 2 elements, the question and the measurement level
-                              as defined in the content object.
+    :param measurement_level: The measurement level of the question, as defined in the content object.
+    :param column: The column of the question, only used to label the metrics (see metrics.py).
 
     :return: A validated response
     :rtype: integer or float
     """
-    # Step 1: Initialize variables to be able to make the comparison within the while loops.
-    user_input_num = -1000
-    user_input_str = ''
-
-    # Step 2a: If the measurement level is yes_no we only accept the words Yes No and their lowercase counter parts as
-    # well as 0, the while loop will keep asking for input for as long as the criteria is not met.
-    if measurement_level == 'yes_no':
-        while user_input_str.lower().strip() not in ('y', 'n', 'yes', 'no', 0):
-            user_input_str = input('Please answer the question with (Y)es or (N)o: ')
-
-    # Step 2b: if the measurement level is likert 5, then the respondent will be requested to provide an input between
-    # 1 and 5, here 0 is also accepted as that acts as a way to skip a question.
-    elif measurement_level == 'likert_5':
-        while 0 <= abs(user_input_num) > 5:
-            try:
-                user_input_num = int(input('Please give an integer between 1 (Not really) '
-                                           'and 5 (Very much so!): '))
-            except ValueError:
-                continue
-
-    # Step 2c: If the measurement level is scale_10, the respondent is asked to provide an input ranging from 1 to 10.
-    # Here, too, 0 is accepted as a way to skip the question.
-    elif measurement_level == 'scale_10':
-        while 0 <= abs(user_input_num) > 11:
-            try:
-                user_input_num = float(input('Please enter a grade between 1 and 10: '))
-            except ValueError:
-                continue
-
-    # Step 2d: If the measurement level is quantity this means that any integer above 0 is accepted. 0 is also accepted
-    # in this case as a way to skip the question.
-    elif measurement_level == 'quantity':
-        while user_input_num < 0 or not isinstance(user_input_num, int):
-            try:
-                user_input_num = int(input('Please enter an integer above 0: '))
-            except ValueError:
-                continue
-
-    # Step 3a: In case a string input is found, 1 will be returned for yes and 0 will be returned for no. Currently no
-    # other string inputs are accepted.
-    if user_input_str:
-        if user_input_str.lower() in ('y', 'yes'):
-            return 1
-        else:
-            return 0
+    # Step 1: Keep asking with the prompt belonging to the measurement level, until the answer is accepted.
+    start = time.perf_counter() if metrics.enabled() else None
+    attempts = 0
+    while True:
+        attempts += 1
+        response = validation.parse_response(measurement_level, input(validation.PROMPTS[measurement_level]))
 
-    # Step 3b: In case a numeric (float | integer) input is found (by seeing whether or not it maches the default
-    # value), this will be returned.
-    elif user_input_num != -1000:
-        return user_input_num
-    
+        # Step 2: Return the response once it is valid, a None means the answer did not meet the criteria. When metrics
+        # are recorded, the time it took to answer and the number of times the question was asked again are noted.
+        if response is not None:
+            if start is not None:
+                labels = {'column': column or '', 'measurement_level': measurement_level}
+                metrics.observe('survey_answer_seconds', time.perf_counter() - start, **labels)
+                metrics.count('survey_reprompts', attempts - 1, **labels)
+            return response
 
-def generate_targets(results, target_goals):
-    """Generate targets for each goal we indicate that needs it
 
-    Purely by chance, all of the goals are of measurement level liker_5, this means the targets are set at 3. The
-    targets are only produced if we actually indicated that this goal was relevant for this week (indicated by
-    any thing other than a 0.
-
-    :rtype: Pandas DataFrame
-    """
-    targets = {}
-
-    for goal in target_goals:
-        targets[f't_{goal}'] = np.where((results[goal][0] == 0 or results[goal][0] == np.nan), 0, 3)
-
-    return pd.DataFrame(targets, index=[0])
+def choose_date(index, page_size=PAGE_SIZE):
+    """Let the respondent choose a date from the index, one page at a time.
 
+    The most recent dates are shown first. Besides the dates, the menu allows moving to the next or previous page and
+    searching for dates starting with a given text (e.g. 2022-03 for all dates in March).
 
-def generate_test_data(storage_dict, measurement_levels):
-    """Generate random input for 52 weeks worth of data for testing purposes
+    :param index: The number of records per date, as returned by storage.date_index.
 
-    Looping 52 times represents the extent of a year. For each loop we assess every key for its measurement level, this
-    way we can insert the correct random input. For the date field we increment today's date with 7 days at each
-    iteration.
+    :return: The chosen date, None if nothing was chosen.
     """
+    import enquiries
 
-    for week in range(0, 52):
-        for key, value in storage_dict.items():
+    dates = index.groupby('date')['records'].sum().sort_index(ascending=False) if not index.empty else index
+    if dates.empty:
+        print('There are no records to delete.')
+        return None
 
-            if key == 'date':
-                storage_dict[key].append(date.today() + timedelta(days=7 * week))
+    shown = dates
+    page = 0
 
-            elif key in measurement_levels['likert_5']:
-                storage_dict[key].append(random.randint(1, 5))
+    while True:
+        pages = max((len(shown) - 1) // page_size + 1, 1)
+        options = [f'{day} ({count} record(s))' for day, count in shown.iloc[page * page_size:(page + 1) * page_size]
+                   .items()]
+        if page + 1 < pages:
+            options.append('Next page')
+        if page > 0:
+            options.append('Previous page')
+        options += ['Search', 'None']
 
-            elif key in measurement_levels['scale_10']:
-                storage_dict[key].append(random.randint(1, 10))
+        choice = enquiries.choose(f'Choose a date of which record you want to delete (page {page + 1}/{pages}): ',
+                                  options)
 
-            elif key in measurement_levels['quantity']:
-                storage_dict[key].append(random.randint(1, 15))
-
-            elif key in measurement_levels['yes_no']:
-                storage_dict[key].append(random.randint(0, 1))
-
-    return pd.DataFrame(storage_dict)
+        if choice == 'None':
+            return None
+        elif choice == 'Next page':
+            page += 1
+        elif choice == 'Previous page':
+            page -= 1
+        elif choice == 'Search':
+            search = input('Enter (the start of) a date, e.g. 2022-03: ').strip()
+            shown = dates[dates.index.astype(str).str.startswith(search)]
+            page = 0
+            if shown.empty:
+                print(f'No dates start with {search}, showing all dates.')
+                shown = dates
+        else:
+            return choice.split(' ')[0]
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mode', choices=['s', 'd', 't'], required=True,
-                        help='With mode, you can specify how you want to initialize the program. There are 3 options:'
+    parser.add_argument('--mode', choices=['s', 'd', 't', 'g', 'i', 'r', 'w'], required=True,
+                        help='With mode, you can specify how you want to initialize the program. There are 7 options:'
                              's = survey mode, this is to record new data. d = deletion mode, this is to delete old'
-                             'records. t = test mode, this creates a test output that can be used to create analyses')
+                             'records. t = test mode, this creates a test output that can be used to create analyses.'
+                             'g = targets mode, this recomputes the targets of all stored years after a rule changed.'
+                             'i = import mode, this validates and stores the responses in a CSV or JSONL file.'
+                             'r = report mode, this shows the weekly progress per sub goal.'
+                             'w = server mode, this serves the survey over HTTP to many respondents at once')
+    parser.add_argument('--rows', type=int, default=52,
+                        help='Test mode only: the number of rows to generate.')
+    parser.add_argument('--respondent',
+                        help='Survey, deletion, test and report mode only: the id of the respondent, whose records are '
+                             'stored in a partition of their own. Without it, the stores in the working directory '
+                             'are used.')
+    parser.add_argument('--respondents', type=int, default=1,
+                        help='Test mode only: the number of respondents the rows are divided over, each respondent '
+                             'gets a partition of their own.')
+    parser.add_argument('--years', type=int, default=1,
+                        help='Test mode only: the number of years the weekly dates are spread over.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Test mode only: seed for the random generator, to reproduce a previous output.')
+    parser.add_argument('--skip-rate', type=float, default=0.0,
+                        help='Test mode only: the chance (0 to 1) that a sub goal is (partially) skipped.')
+    parser.add_argument('--chunk-size', type=int, default=100_000,
+                        help='Test and import mode only: the number of rows generated or read at a time.')
+    parser.add_argument('--input',
+                        help='Import mode only: the CSV or JSONL file with responses to import.')
+    parser.add_argument('--sep', default=',',
+                        help='Import mode only: the separator used in the CSV file.')
+    parser.add_argument('--date',
+                        help='Deletion mode only: the date (YYYY-MM-DD) of which the records are deleted.')
+    parser.add_argument('--date-from',
+                        help='Deletion mode only: delete the records from this date (YYYY-MM-DD) onwards.')
+    parser.add_argument('--date-to',
+                        help='Deletion mode only: delete the records up to and including this date (YYYY-MM-DD).')
+    parser.add_argument('--where',
+                        help="Deletion mode only: delete the records matching this condition, e.g. 'sg_1_1_1 == 0'.")
+    parser.add_argument('--year', default=date.today().strftime('%Y'),
+                        help='Deletion mode only: the year to pick a date from or apply --where to, defaults to the '
+                             'current year.')
+    parser.add_argument('--weeks', type=int, default=12,
+                        help='Report mode only: the number of most recent weeks to report on.')
+    parser.add_argument('--output',
+                        help='Report mode only: a CSV file to write the weekly report to.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Server mode only: the address to listen on.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Server mode only: the port to listen on.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Import and targets mode only: the number of processes validating the responses and '
+                             'merging the stores.')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print how long the program took to start and which imports took longest, on exit.')
+    parser.add_argument('--metrics',
+                        help='Record how long every stage takes and write the metrics to this file on exit.')
+    parser.add_argument('--metrics-format', choices=['prometheus', 'jsonl'],
+                        help='The format of the --metrics file, by default jsonl for .jsonl files and prometheus '
+                             'otherwise.')
     args, unknown = parser.parse_known_args()
 
+    if args.metrics:
+        metrics.enable(args.metrics, args.metrics_format)
+
+    if args.respondent is not None:
+        import storage
+        try:
+            storage.partition_directory(args.respondent)
+        except ValueError as error:
+            parser.error(str(error))
+
     # Step 1: Establish the date of today, this is to simplify syntax later on.
     today = date.today()
 
+    # Step 2: Compile the survey content into the plan of questions, columns and measurement levels used by all modes.
+    plan = schema.compile_plan(survey_content)
+
     # Depending on the mode the user desires to use the program in, different behaviour is triggered:
     # If the program is initialized in survey mode:
     if args.mode == 's':
 
-        # Step 1: Initialize storage object
-        weekly_result = {
-            'date': today,
-            'sg_1_1_1': np.nan, 'sg_1_1_2': np.nan, 'sg_1_1_3': np.nan,
-            'sg_1_2_1': np.nan, 'sg_1_2_2': np.nan, 'sg_1_2_3': np.nan,
-            'sg_1_3_1': np.nan, 'sg_1_3_2': np.nan,
-            'sg_1_4_1': np.nan, 'sg_1_4_2': np.nan,
-            'sg_1_5_1': np.nan, 'sg_1_5_2': np.nan,
-            'sg_2_1_1': np.nan,
-            'sg_2_2_1': np.nan, 'sg_2_2_2': np.nan,
-            'sg_2_3_1': np.nan,
-            'sg_2_4_1_python': np.nan, 'sg_2_4_1_sql': np.nan, 'sg_2_4_1_tableau': np.nan, 'sg_2_4_1_powerpoint': np.nan,
-            'gnrl_1': np.nan,
-            'gnrl_2': np.nan,
-            'gnrl_3': np.nan
-        }
+        # The record of a single survey is a plain dictionary from start to end, none of this needs pandas.
+        import journal
+        import storage
 
-        # Step 2: Start survey
-        survey_results = start_survey(weekly_result, survey_content)
-
-        # Step 3: Generate targets for relevant questions (mainly likert_5 questions).
-        goals_needing_targets = ['sg_2_1_1', 'sg_2_2_2', 'sg_2_3_1', 'sg_2_4_1_python', 'sg_2_4_1_sql',
-                                 'sg_2_4_1_tableau', 'sg_2_4_1_powerpoint', 'gnrl_1', 'gnrl_2', 'gnrl_3']
+        # Step 1: Initialize storage object. Every answer is journaled as it is given, an interrupted survey is resumed
+        # from its journal and keeps the date it was started on.
+        session = journal.open_journal(plan, journal.TERMINAL_SESSION, today.isoformat(), respondent=args.respondent)
+        weekly_result = schema.empty_record(plan, session.date, args.respondent)
+        stem = storage.store_stem(session.date[:4], respondent=args.respondent)
 
-        results = pd.concat([survey_results, generate_targets(survey_results, goals_needing_targets)], axis=1)
+        # Step 2: Start survey
+        survey_results = start_survey(weekly_result, survey_content, args.respondent, session)
 
-        # Step 4: Store results
-        try:
-            existing_results = pd.read_csv(f"goals_monitoring_{today.strftime('%Y')}.csv",
-                                           sep=';', index_col=0)
-            full_df = pd.concat([existing_results, results], axis=0)
-            full_df.to_csv(f"goals_monitoring_{today.strftime('%Y')}.csv", sep=';')
-        except FileNotFoundError:
-            results.to_csv(f"goals_monitoring_{today.strftime('%Y')}.csv", sep=';')
+        # Step 3: Store the results along with their targets, a merge started meanwhile is waited for on exit.
+        store_survey(survey_results, stem, session, plan, survey_content)
 
     # If the survey is initialized in deletion mode:
     elif args.mode == 'd':
 
-        # Step 1: Load in the current data.
-        current_data = pd.read_csv(f"goals_monitoring_{today.strftime('%Y')}.csv", sep=';')
+        import aggregates
+        import storage
 
-        # Step 2: Generate the decision menu and present this to the user.
-        options = list(current_data.sort_values('date', ascending=False)['date'])
-        options.append('None')
-        choice = enquiries.choose('Choose a date of which record you want to delete: ', options)
-
-        # Step 2b: Allow early break. If None is selected, exit script.
-        if choice == 'None':
+        # Step 1: Determine what to delete. Without any conditions given on the command line, a date is picked from
+        # the index of this year's records. Only the stores of the given respondent (if any) are touched.
+        date_from = args.date or args.date_from
+        date_to = args.date or args.date_to
+        try:
+            date_from = date.fromisoformat(date_from).isoformat() if date_from else None
+            date_to = date.fromisoformat(date_to).isoformat() if date_to else None
+        except ValueError as error:
+            parser.error(f'Invalid date, expected YYYY-MM-DD: {error}')
+
+        if not (date_from or date_to or args.where):
+            with metrics.span('delete.index'):
+                index = storage.date_index(storage.store_stem(args.year, respondent=args.respondent))
+            choice = choose_date(index)
+
+            # Step 1b: Allow early break. If None is selected, exit script.
+            if choice is None:
+                sys.exit(0)
+            date_from = date_to = choice
+
+        # Step 2: A range may span several years, each stored year within the range is included. A range open on one
+        # end includes every stored year on that side. Without dates, the condition applies to the given year.
+        first_year = date_from[:4] if date_from else ('0000' if date_to else str(args.year))
+        last_year = date_to[:4] if date_to else ('9999' if date_from else str(args.year))
+        stems = []
+        for stem, respondent in storage.list_stores(respondents=None if args.respondent is None else [args.respondent]):
+            year = os.path.basename(stem)[len('goals_monitoring_'):]
+            if respondent == args.respondent and os.path.basename(stem).startswith('goals_monitoring_') and \
+                    year.isdigit() and first_year <= year.zfill(4) <= last_year:
+                stems.append(stem)
+
+        # A condition that can't be evaluated on the records would delete nothing, refuse it before it is stored.
+        if args.where:
+            for stem in stems:
+                try:
+                    storage.check_condition(stem, args.where)
+                except ValueError as error:
+                    parser.error(str(error))
+
+        description = ' and '.join(condition for condition in (
+            f'from {date_from}' if date_from else '', f'up to {date_to}' if date_to else '',
+            f'where {args.where}' if args.where else '') if condition)
+
+        if not stems:
+            print(f'There are no stored records {description}, nothing has been deleted.')
             sys.exit(0)
 
         # Step 3: Ask the user for confirmation.
-        confirmation = input(f'Are you sure you want to delete the record for {choice}?\n Write Yes to confirm: ')
+        confirmation = input(f'Are you sure you want to delete the records {description}?\n Write Yes to confirm: ')
 
-        # Step 4: Check if confirmation is received. If so, delete record, else print notification and end script
+        # Step 4: Check if confirmation is received. If so, delete the records by writing a tombstone to each store,
+        # else print notification and end script
         if confirmation.lower() == 'yes':
-            current_data.drop(current_data[current_data['date'] == choice].index, inplace=True)
-            current_data.to_csv(f"goals_monitoring_{today.strftime('%Y')}.csv", sep=';')
-            print(f'The record for date {choice} has been deleted.')
+            for stem in stems:
+                with metrics.span('delete.tombstone'):
+                    storage.delete_records(stem, date_from=date_from, date_to=date_to, where=args.where)
+                with metrics.span('delete.aggregates'):
+                    aggregates.refresh(stem, plan, date_from=None if args.where else date_from,
+                                       date_to=None if args.where else date_to)
+            print(f'The records {description} have been deleted.')
         else:
             print("You did not answer 'Yes', nothing has been deleted")
 
     # If the program is initialized in test mode:
     elif args.mode == 't':
 
+        import storage
+        import synthetic_data
+
         print('Generating Test Data . . . ')
+        name = f"TEST_DATA_goals_monitoring_{today.strftime('%Y')}.csv"
+
+        # Step 1: Generate the data column by column and stream it to disk in chunks. The data of a given respondent,
+        # or of several respondents, is split over their partitions the way their answers are stored.
+        if args.respondent is not None or args.respondents > 1:
+            paths = synthetic_data.generate_partitioned_test_data(
+                name, plan, rows=args.rows, respondents=args.respondents, years=args.years, seed=args.seed,
+                skip_rate=args.skip_rate, chunk_size=args.chunk_size,
+                respondent_ids=None if args.respondent is None else [args.respondent])
+            print(f"Done, the data of {len(paths)} respondent(s) is stored under "
+                  f"{os.path.abspath(os.path.join(storage.PARTITIONS_DIRECTORY, '<respondent>', name))}")
+        else:
+            synthetic_data.generate_test_data(name, plan, rows=args.rows, years=args.years, seed=args.seed,
+                                              skip_rate=args.skip_rate, chunk_size=args.chunk_size)
+            print(f"Done, data is stored under {os.getcwd()}/{name}")
+
+    # If the program is initialized in targets mode:
+    elif args.mode == 'g':
+
+        import aggregates
+        import targets
+
+        # Step 1: Recompute the targets of every yearly file in the working directory (and the respondent partitions)
+        # in one pass.
+        updated = targets.recompute_targets(survey_content, workers=args.workers)
+
+        # Step 2: The target attainment in the aggregates depends on the targets, these are rebuilt as well.
+        for stem in updated:
+            aggregates.rebuild(stem, plan)
+
+        print(f"Done, the targets of {len(updated)} file(s) have been recomputed.")
+
+    # If the program is initialized in import mode:
+    elif args.mode == 'i':
+
+        import ingest
+
+        if not args.input:
+            parser.error('import mode requires --input')
+
+        # Step 1: Validate the responses chunk by chunk and store the accepted ones.
+        accepted, rejected = ingest.import_responses(args.input, plan, survey_content, sep=args.sep,
+                                                     chunk_size=args.chunk_size, workers=args.workers)
+
+        # Step 2: Let the user know where the rejected responses can be found.
+        print(f"Done, {accepted} response(s) have been stored.")
+        if rejected:
+            print(f"{rejected} response(s) were rejected, these can be found together with the reason under:\n "
+                  f"{os.path.splitext(os.path.abspath(args.input))[0]}.rejected.csv")
+
+    # If the program is initialized in report mode:
+    elif args.mode == 'r':
+
+        import aggregates
+        import query
+
+        # Step 1: Build the report from the weekly aggregates of every yearly file, those of a single respondent when
+        # one is given.
+        stems = [source.stem for source in query.open_dataset(
+            respondents=None if args.respondent is None else [args.respondent])]
+        report = aggregates.build_report(stems, plan, weeks=args.weeks)
+
+        if report.empty:
+            print('There are no records to report on yet.')
+            sys.exit(0)
+
+        # Step 2: Print the most recent week per question, optionally storing all weeks.
+        latest = report.groupby('column', sort=False).tail(1).set_index(['sub_goal', 'column'])
+        print(f"Progress over the week of {latest['week'].iloc[0]}:\n")
+        print(latest.drop(columns='week').to_string())
+
+        if args.output:
+            report.to_csv(args.output, sep=';', index=False)
+            print(f"\nThe report for the last {args.weeks} weeks is stored under {os.path.abspath(args.output)}")
+
+    # If the program is initialized in server mode:
+    elif args.mode == 'w':
+
+        import server
 
-        # Step 1: Initialize Storage
-        test_output = {
-            'date': [],
-            'sg_1_1_1': [], 'sg_1_1_2': [], 'sg_1_1_3': [],
-            'sg_1_2_1': [], 'sg_1_2_2': [], 'sg_1_2_3': [],
-            'sg_1_3_1': [], 'sg_1_3_2': [],
-            'sg_1_4_1': [], 'sg_1_4_2': [],
-            'sg_1_5_1': [], 'sg_1_5_2': [],
-            'sg_2_1_1': [],
-            'sg_2_2_1': [], 'sg_2_2_2': [],
-            'sg_2_3_1': [],
-            'sg_2_4_1_python': [], 'sg_2_4_1_sql': [], 'sg_2_4_1_tableau': [], 'sg_2_4_1_powerpoint': [],
-            'gnrl_1': [],
-            'gnrl_2': [],
-            'gnrl_3': []
-        }
-
-        # Step 2: Initialize measurement levels, in order to ensure representative random output.
-        measurement_levels_dict = {
-            'likert_5': ['sg_1_2_3', 'sg_2_1_1', 'sg_2_3_1', 'sg_2_4_1_python', 'sg_2_4_1_sql', 'sg_2_4_1_tableau',
-                         'sg_2_4_1_powerpoint', 'gnrl_1', 'gnrl_2', 'gnrl_3'],
-            'scale_10': ['sg_1_5_1', 'sg_1_5_2'],
-            'quantity': ['sg_1_1_2', 'sg_1_1_3', 'sg_1_2_2', 'sg_1_3_1', 'sg_1_3_2', 'sg_1_4_1', 'sg_1_4_2',
-                         'sg_2_2_1'],
-            'yes_no': ['sg_1_1_1', 'sg_1_2_1', 'sg_2_2_2']
-        }
-
-        generate_test_data(test_output, measurement_levels_dict).to_csv(
-            f"TEST_DATA_goals_monitoring_{today.strftime('%Y')}.csv", sep=';')
-
-        print(f"Done, data is stored under {os.getcwd()}/TEST_DATA_goals_monitoring_{today.strftime('%Y')}.csv")
+        # Step 1: Serve the survey until ctrl+c is pressed, completed surveys are stored as they come in.
+        server.run(survey_content, host=args.host, port=args.port)
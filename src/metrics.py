@@ -0,0 +1,171 @@
+"""
+This document records where the time goes (--metrics), as timing spans, counters and observations.
+
+Instrumented code marks its stages with spans:
+
+    with metrics.span('survey.store'):
+        storage.append_record(...)
+
+and records single values with metrics.observe (e.g. the time a respondent took to answer a question) and metrics.count
+(e.g. the number of times a question was asked again). Labels tell apart the same metric for different questions.
+
+Nothing is recorded unless metrics are enabled, in which case one of two formats is written:
+    prometheus: the totals per metric in the Prometheus text format, written when the program exits. Spans and
+                observations are summaries (<name>_count and <name>_sum, next to a <name>_max gauge), all spans
+                together form goals_span_seconds with the name of the span as label. Counters end in _total.
+    jsonl: every span, observation and count as a line of JSON, written as it happens.
+
+When disabled, span returns the same empty context manager every time and observe and count return immediately, so the
+instrumentation can stay on the hot paths.
+
+"""
+import atexit
+import json
+import os
+import re
+import threading
+import time
+
+# The prefix of every metric in the Prometheus output.
+NAMESPACE = 'goals'
+
+_config = {'path': None, 'format': None}
+_lock = threading.Lock()
+_summaries = {}
+_counters = {}
+_events = None
+
+
+class _NoSpan:
+    """The span handed out while metrics are disabled, it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Span:
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record('span', self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enabled():
+    return _config['path'] is not None
+
+
+def enable(path, output_format=None):
+    """Start recording metrics, which are written to the given file.
+
+    :param path: The file to write to, it is overwritten when it exists.
+    :param output_format: prometheus or jsonl, by default jsonl for .jsonl and .json files and prometheus otherwise.
+    """
+    global _events
+
+    if output_format is None:
+        output_format = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'prometheus'
+    if output_format not in ('prometheus', 'jsonl'):
+        raise ValueError(f'Unknown metrics format: {output_format}')
+
+    _config.update(path=path, format=output_format)
+    if output_format == 'jsonl':
+        _events = open(path, 'w', encoding='utf-8')
+    atexit.register(export)
+
+
+def span(name, **labels):
+    """Time the with block under the given name, see the module documentation."""
+    if _config['path'] is None:
+        return _NO_SPAN
+    return _Span(name, labels)
+
+
+def observe(name, value, **labels):
+    """Record a single value, such as a duration in seconds."""
+    if _config['path'] is not None:
+        _record('observation', name, value, labels)
+
+
+def count(name, value=1, **labels):
+    """Add to a counter."""
+    if _config['path'] is not None:
+        _record('count', name, value, labels)
+
+
+def _record(kind, name, value, labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if _events is not None:
+            _events.write(json.dumps({'time': time.time(), 'type': kind, 'name': name, 'value': value,
+                                      'labels': labels}) + '\n')
+        elif kind == 'count':
+            _counters[key] = _counters.get(key, 0) + value
+        else:
+            summary = _summaries.setdefault((kind, key), [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', f'{NAMESPACE}_{name}')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def prometheus_text():
+    """Return the recorded totals in the Prometheus text format."""
+    families = {}
+
+    # Spans are all part of one family, with the name of the span as a label.
+    with _lock:
+        for (kind, (name, labels)), (total, value_sum, value_max) in sorted(_summaries.items()):
+            metric = _metric_name('span_seconds' if kind == 'span' else name)
+            labels = (('span', name),) + labels if kind == 'span' else labels
+            families.setdefault((metric, 'summary'), []).extend([
+                (f'{metric}_count', labels, total), (f'{metric}_sum', labels, value_sum)])
+            families.setdefault((f'{metric}_max', 'gauge'), []).append((f'{metric}_max', labels, value_max))
+        for (name, labels), value in sorted(_counters.items()):
+            metric = _metric_name(f'{name}_total')
+            families.setdefault((metric, 'counter'), []).append((metric, labels, value))
+
+    lines = []
+    for (metric, metric_type), samples in families.items():
+        lines.append(f'# TYPE {metric} {metric_type}')
+        lines.extend(f'{sample}{_labels(labels)} {value}' for sample, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def export():
+    """Write the recorded metrics to the file given to enable, this happens automatically when the program exits."""
+    if not enabled():
+        return
+    with _lock:
+        if _events is not None:
+            _events.flush()
+            return
+
+    temp_path = f'{_config["path"]}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as temp:
+        temp.write(prometheus_text())
+    os.replace(temp_path, _config['path'])
@@ -0,0 +1,115 @@
+"""
+This document exposes all stored data, spread over one file per year (and respondent), as a single lazy dataset.
+
+Nothing is read when the dataset is opened, only the files present in the directory are listed. A query then narrows
+down what is read in four ways:
+    respondents: opening the dataset for some respondents only lists their partitions, see storage.list_stores
+    years: a file of which the year falls outside the requested dates is skipped without opening it
+    dates: the date index of a file (see storage.date_index) shows whether it holds any date in range at all
+    columns: only the requested columns are parsed, patterns such as 'sg_2_4_1_*' are allowed
+The records that remain are streamed in chunks, so memory depends on the chunk size rather than the number of years.
+
+Example, the last 12 weeks of the tool questions of respondent jdoe:
+    query.scan(query.open_dataset(respondents=['jdoe']), columns=['sg_2_4_1_*'],
+               date_from=date.today() - timedelta(weeks=12))
+
+"""
+import fnmatch
+import os
+import re
+from collections import namedtuple
+from datetime import date
+
+import pandas as pd
+
+import storage
+
+Source = namedtuple('Source', ['stem', 'year', 'test', 'respondent'], defaults=[None])
+Source.__doc__ = """A single store. For test data the year is the year it was generated in, its records can span
+several years. The respondent is None for the stores kept outside of the respondent partitions."""
+
+_STORE_NAME = re.compile(r'^(TEST_DATA_)?goals_monitoring_(\d{4})$')
+
+
+def open_dataset(directory='.', include_test=False, respondents=None):
+    """List the yearly stores (and optionally the test data files) in the directory.
+
+    :param respondents: Only list the stores of these respondents, None for all stores.
+
+    :return: The sources, ordered by year with the test data last.
+    :rtype: list of Source
+    """
+    sources = []
+    for stem, respondent in storage.list_stores(directory, respondents):
+        match = _STORE_NAME.match(os.path.basename(stem))
+        if match and (include_test or not match.group(1)):
+            sources.append(Source(stem, int(match.group(2)), bool(match.group(1)), respondent))
+
+    return sorted(sources, key=lambda source: (source.test, source.year, source.respondent or ''))
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _in_range(source, date_from, date_to):
+    """Check whether a source can hold any record in the date range, first by its year and then by its index."""
+    if not source.test:
+        if date_from and date_from > f'{source.year}-12-31':
+            return False
+        if date_to and date_to < f'{source.year}-01-01':
+            return False
+
+    if date_from or date_to:
+        dates = storage.date_index(source.stem)
+        if dates.empty:
+            return False
+        dates = dates['date'].astype(str)
+        return bool(((dates >= (date_from or '')) & (dates <= (date_to or '9999'))).any())
+
+    return True
+
+
+def resolve_columns(patterns, available):
+    """Return the available columns matching any of the patterns, in the order they are available in."""
+    return [column for column in available if any(fnmatch.fnmatchcase(column, pattern) for pattern in patterns)]
+
+
+def scan(sources, columns=None, date_from=None, date_to=None, chunk_size=100_000, typed=False):
+    """Stream the records of the sources that match the date range, with only the requested columns.
+
+    :param sources: The sources to query, as returned by open_dataset.
+    :param columns: Column names or patterns (e.g. 'sg_2_4_1_*'), None for all columns. The date is always included.
+    :param date_from: The first date (inclusive), as a date or ISO formatted string.
+    :param date_to: The last date (inclusive), as a date or ISO formatted string.
+    :param chunk_size: The maximum number of records read from a file at a time.
+    :param typed: Whether to return the answers in their compact types (nullable Int8 and the like, dates as datetime64)
+                  instead of float64 and text, see columnar.py. This takes a fraction of the memory.
+
+    :return: A generator of DataFrames with the date as first column.
+    """
+    date_from, date_to = _iso(date_from), _iso(date_to)
+
+    for source in sources:
+        if not _in_range(source, date_from, date_to):
+            continue
+
+        selected = None
+        if columns is not None:
+            selected = ['date'] + [column for column in resolve_columns(columns, storage.store_columns(source.stem))
+                                   if column != 'date']
+
+        for chunk in storage.scan_records(source.stem, selected, chunk_size, typed):
+            if date_from or date_to:
+                dates = chunk['date'].astype(str)
+                chunk = chunk[(dates >= (date_from or '')) & (dates <= (date_to or '9999'))]
+            if not chunk.empty:
+                yield chunk
+
+
+def read(sources, columns=None, date_from=None, date_to=None, chunk_size=100_000, typed=False):
+    """Run a query and collect the result in a single DataFrame, see scan for the parameters."""
+    chunks = list(scan(sources, columns, date_from, date_to, chunk_size, typed))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, axis=0, ignore_index=True)
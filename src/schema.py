@@ -0,0 +1,325 @@
+"""
+This document compiles the survey content into a flat question plan.
+
+The content (survey_content.py) describes the survey as nested goals, sub goals and questions. Everything else in the
+program needs the same information in a flat shape: the columns a record consists of, in the order they are stored,
+together with the measurement level and data type of each of them. compile_plan walks the content once and produces
+exactly that, so adding a question to the content is all it takes to have it asked, stored, generated and analysed.
+
+Each column is named after its position in the content:
+    sg_<goal>_<sub goal>_<question>: a question of a sub goal
+    sg_<goal>_<sub goal>_<question>_<element>: an element of a nested question, e.g. sg_2_4_1_python
+    gnrl_<goal>: the general goals
+    t_<column>: the target of a column, see targets.py
+
+Because names follow positions, adding or removing a question renames the questions after it. Every stored record
+therefore carries the hash of the layout it was stored in, a list of its columns along with the question each column
+holds (see layout_hash). Records of an earlier layout are projected onto the current one when they are read (see
+projection): columns are matched on their question, so a column that moved is renamed, while columns of removed
+questions are left out. When matching on the question doesn't suffice, survey_content.schema_changes lists renames,
+defaults and drops for a given earlier layout. The records on disk are never rewritten for this.
+
+"""
+import hashlib
+import json
+from collections import namedtuple
+
+# The data type of each measurement level, being the smallest type able to hold every valid answer.
+LEVEL_DTYPES = {
+    'likert_5': 'int8',
+    'yes_no': 'int8',
+    'scale_10': 'float32',
+    'quantity': 'int32',
+}
+
+Question = namedtuple('Question', ['column', 'text', 'measurement_level', 'goal', 'goal_number', 'sub_goal',
+                                   'sub_goal_key', 'sub_goal_number', 'nested_in'])
+Question.__doc__ = """A single question as it is asked and stored. For elements of a nested question, text holds the
+element and nested_in the question it belongs to. For general goals, goal is None and sub_goal_key is 'gnrl'."""
+
+Plan = namedtuple('Plan', ['content_hash', 'questions', 'columns', 'target_columns', 'record_columns', 'dtypes',
+                           'level_of', 'measurement_levels', 'layout', 'schema_hash'])
+Plan.__doc__ = """The compiled content. columns holds the question columns, record_columns the full layout of a stored
+record: date, question columns and target columns. layout describes these columns by their question and schema_hash
+identifies the layout, see layout_hash."""
+
+Projection = namedtuple('Projection', ['version', 'renames', 'leftovers', 'defaults', 'keep'])
+Projection.__doc__ = """How records stored under an earlier layout (version) are read in the current one. renames maps
+stored columns to current columns, leftovers holds the stored columns without a place in the current layout and
+defaults the values of current columns the stored records lack. keep lists every column of the current layout."""
+
+# Columns of a record that don't belong to the content, they are never renamed or left out.
+RECORD_KEYS = ('date', 'respondent')
+
+# Separates the name of a leftover column from the version it was kept from, e.g. sg_1_5_2@3f2a9c01d4e5b6a7.
+LEFTOVER_MARK = '@'
+
+# The version of records stored before layouts were recorded, their columns are matched by name.
+UNVERSIONED = 'unversioned'
+
+# The parts of the content that determine the layout of a record.
+CONTENT_ATTRIBUTES = ('overarching_goals', 'sub_goals', 'questions_by_subgoals', 'general_questions', 'target_goals')
+
+_plans = {}
+_compiled = {}
+
+
+def _content_parts(content):
+    return [getattr(content, attribute, []) for attribute in CONTENT_ATTRIBUTES]
+
+
+def content_hash(content):
+    """Hash everything in the content that determines the layout of a record."""
+    return hashlib.sha256(json.dumps(_content_parts(content), sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _walk_content(content):
+    """Yield a Question for every answer recorded by the survey, in the order in which they are asked."""
+    for i, goal in enumerate(content.overarching_goals):
+        for j, sub_goal in enumerate(content.sub_goals[f'og_{i + 1}']):
+            sub_goal_key = f'og_{i + 1}_{j + 1}'
+
+            for k, question in enumerate(content.questions_by_subgoals[sub_goal_key]):
+                column = f'sg_{i + 1}_{j + 1}_{k + 1}'
+
+                if question[1] == 'nested':
+                    for element in question[2]:
+                        yield Question(f'{column}_{element[0].lower()}', element[0], element[1], goal, i + 1,
+                                       sub_goal, sub_goal_key, j + 1, question[0])
+                else:
+                    yield Question(column, question[0], question[1], goal, i + 1, sub_goal, sub_goal_key, j + 1, None)
+
+    # For the general goals, the fourth general question is all that is desired to know.
+    general_question = content.general_questions[3]
+    for i, sub_goal in enumerate(content.sub_goals['gnrl']):
+        yield Question(f'gnrl_{i + 1}', general_question[0], general_question[1], None, None, sub_goal, 'gnrl', i + 1,
+                       None)
+
+
+def compile_plan(content):
+    """Compile the content into a Plan.
+
+    The plan is cached by the hash of the content, compiling the same content a second time returns the same plan.
+    Hashing takes a while compared to appending a record, which compiles the plan as well. The plan of a content
+    object is therefore returned right away as long as none of its parts were replaced (parts changed in place are
+    not noticed, the content is not meant to change while the program runs).
+
+    :param content: a .py file containing all goals and questions.
+
+    :rtype: Plan
+    """
+    parts = _content_parts(content)
+    compiled = _compiled.get(id(content))
+    if compiled is not None and compiled[0] is content and all(a is b for a, b in zip(compiled[1], parts)):
+        return compiled[2]
+
+    key = content_hash(content)
+    if key in _plans:
+        _compiled[id(content)] = (content, parts, _plans[key])
+        return _plans[key]
+
+    questions = tuple(_walk_content(content))
+    columns = tuple(question.column for question in questions)
+    level_of = {question.column: question.measurement_level for question in questions}
+
+    measurement_levels = {level: [] for level in LEVEL_DTYPES}
+    for question in questions:
+        measurement_levels[question.measurement_level].append(question.column)
+
+    target_columns = tuple(f't_{goal}' for goal in getattr(content, 'target_goals', []))
+    dtypes = {column: LEVEL_DTYPES[level_of[column]] for column in columns}
+    dtypes.update({column: 'int8' for column in target_columns})
+
+    record_columns = ('date',) + columns + target_columns
+    record_layout = _layout(questions, record_columns)
+
+    _plans[key] = Plan(key, questions, columns, target_columns, record_columns, dtypes, level_of, measurement_levels,
+                       record_layout, layout_hash(record_layout))
+    _compiled[id(content)] = (content, parts, _plans[key])
+    return _plans[key]
+
+
+def _identity(question):
+    """The question a column holds: its sub goal, text, measurement level and the question it is nested in."""
+    return [question.sub_goal, question.text, question.measurement_level, question.nested_in]
+
+
+def _kind(identity):
+    """Whether a column holds a target, along with its measurement level."""
+    return identity[0] == 'target', identity[-2]
+
+
+def _layout(questions, record_columns):
+    identities = {question.column: _identity(question) for question in questions}
+    layout = []
+    for column in record_columns:
+        if column.startswith('t_') and column[2:] in identities:
+            layout.append([column, ['target'] + identities[column[2:]]])
+        else:
+            layout.append([column, identities.get(column)])
+    return layout
+
+
+def layout_hash(layout):
+    """Hash a layout, the list of [column, identity] pairs describing the columns of a record in order. The identity
+    of a column is the question it holds (None for the date and columns kept from earlier versions)."""
+    return hashlib.sha256(json.dumps(layout).encode('utf-8')).hexdigest()[:16]
+
+
+def projection(plan, stored_layout=None, changes=None, version=UNVERSIONED):
+    """Work out how records stored under another layout are read in the layout of the plan.
+
+    Columns are matched on the question they hold rather than on their name, which changes when questions are added
+    or removed in front of them. A column of which the question isn't found anymore keeps its name when the plan holds
+    a new question of the same measurement level under that name, which is what rewording a question looks like. When
+    a question was replaced by another instead, list it under drops in the changes. Any other column is a leftover:
+    reads leave it out, merges keep it under a name of its own (see project).
+
+    :param plan: The compiled survey content to read the records in.
+    :param stored_layout: The layout the records were stored in, see layout_hash. None for records of which the layout
+                          is unknown, their columns are matched by name.
+    :param changes: The changes listed for this layout in survey_content.schema_changes:
+                    {'renames': {stored: current}, 'defaults': {current: value}, 'drops': [stored, ...]}
+    :param version: The hash of the stored layout.
+
+    :return: None when the records are stored in the layout of the plan, which means there is nothing to do.
+    :rtype: Projection
+    """
+    if version == plan.schema_hash and not changes:
+        return None
+    changes = changes or {}
+
+    current = {column: identity for column, identity in plan.layout}
+    stored = {column: identity for column, identity in stored_layout or [] if identity is not None}
+    by_identity = {json.dumps(identity): column for column, identity in plan.layout if identity is not None}
+    stored_identities = {json.dumps(identity) for identity in stored.values()}
+
+    # Step 1: Match the columns on their question.
+    matched, unmatched = {}, []
+    for column, identity in stored.items():
+        match = by_identity.get(json.dumps(identity))
+        if match is None:
+            unmatched.append(column)
+        else:
+            matched[column] = match
+    renames = {column: match for column, match in matched.items() if match != column}
+    taken = set(matched.values())
+
+    # Step 2: Unmatched columns keep their name when it holds a new question of the same kind, anything else is left
+    # over.
+    leftovers = set()
+    for column in unmatched:
+        identity = current.get(column)
+        if identity is not None and column not in taken and json.dumps(identity) not in stored_identities and \
+                _kind(identity) == _kind(stored[column]):
+            taken.add(column)
+        else:
+            leftovers.add(column)
+
+    # Step 3: Explicit changes come last. A column renamed onto a current column takes its place, the stored column
+    # that would otherwise end up there is left over.
+    explicit = changes.get('renames', {})
+    for column, target in explicit.items():
+        leftovers.discard(column)
+        for other in [other for other in stored if other not in explicit and renames.get(other, other) == target]:
+            leftovers.add(other)
+        if target not in renames and target not in explicit:
+            leftovers.add(target)
+    renames.update(explicit)
+    leftovers.update(changes.get('drops', []))
+
+    return Projection(version, renames, frozenset(leftovers), dict(changes.get('defaults', {})),
+                      frozenset(plan.record_columns) | frozenset(RECORD_KEYS))
+
+
+def projected_name(projection, column, drop=True):
+    """Return the name of a stored column in the current layout, None when it is left out.
+
+    :param drop: Whether leftovers are left out. If not, a leftover gets the name <column>@<version>, which never
+                 clashes with a column of the content.
+    """
+    if projection is None:
+        return column
+    if column in projection.leftovers:
+        target = None
+    else:
+        target = projection.renames.get(column, column)
+        target = target if target in projection.keep else None
+    if target is not None or drop:
+        return target
+    return column if LEFTOVER_MARK in column else f'{column}{LEFTOVER_MARK}{projection.version}'
+
+
+def project(frame, projection, drop=True):
+    """Bring a frame of stored records into the current layout: rename, add the defaults and drop (or keep) leftovers.
+
+    Only column labels change, the values are not copied.
+    """
+    if projection is None:
+        return frame
+
+    columns, names = [], []
+    for column in frame.columns:
+        name = projected_name(projection, column, drop)
+        if name is not None:
+            columns.append(column)
+            names.append(name)
+
+    frame = frame[columns] if len(columns) < len(frame.columns) else frame.copy(deep=False)
+    frame.columns = names
+    for column, value in projection.defaults.items():
+        if column not in frame.columns:
+            frame[column] = value
+    return frame
+
+
+def project_record(record, projection, drop=True):
+    """Bring a single stored record (a dictionary) into the current layout, see project."""
+    if projection is None:
+        return record
+    projected = {}
+    for column, value in record.items():
+        name = projected_name(projection, column, drop)
+        if name is not None:
+            projected[name] = value
+    for column, value in projection.defaults.items():
+        projected.setdefault(column, value)
+    return projected
+
+
+def walk(plan):
+    """Walk through the questions of the plan in the order in which they are asked, skipping what isn't relevant.
+
+    This is a generator: every question that has to be asked is yielded and the validated response is expected back
+    through send. Once a question of a sub goal is answered with no (or 0), the remaining questions of that sub goal
+    are skipped. Elements of a nested question and the general goals are always asked.
+
+    :param plan: The compiled survey content.
+
+    :return: The responses by column, as the value of the StopIteration.
+    """
+    responses = {}
+    skipped_sub_goal = None
+
+    for question in plan.questions:
+        skippable = question.nested_in is None and question.sub_goal_key != 'gnrl'
+        if skippable and question.sub_goal_key == skipped_sub_goal:
+            continue
+
+        response = yield question
+
+        if skippable and response in ('n', 'no', 0):
+            skipped_sub_goal = question.sub_goal_key
+            continue
+        responses[question.column] = response
+
+    return responses
+
+
+def empty_record(plan, record_date, respondent=None):
+    """Return a record for the given date (and respondent) in which every question is still unanswered (NaN)."""
+    record = {'date': record_date}
+    if respondent is not None:
+        record['respondent'] = respondent
+    record.update({column: float('nan') for column in plan.columns})
+    return record
@@ -0,0 +1,273 @@
+"""
+This document serves the survey over HTTP (server mode), so a whole team can take it at the same time.
+
+Every respondent gets a session which walks through the same questions as prompt_questions does, including skipping
+the rest of a sub goal after a no and the separate elements of nested questions. Answers are validated with the rules
+of validation.py. The server speaks a small JSON API:
+
+    POST /sessions                  start a session, the response holds the session id and the first question. An
+                                    optional {"respondent": "..."} stores the answers in the partition of that
+                                    respondent (see storage.py)
+    GET  /sessions/<id>             show the current question of a session
+    POST /sessions/<id>/answer      answer the current question with {"answer": "..."}, the response holds either the
+                                    next question, the same question with the prompt when the answer wasn't valid, or
+                                    done once the survey is completed
+    GET  /health                    check whether the server is running
+
+Sessions never touch the storage themselves. Completed surveys are put on a queue that is drained by a single writer,
+which stores everything that arrived close together in one batch. This keeps the files free of concurrent writers and
+the number of writes low, no matter how many respondents finish at the same time. The final answer of a session is only
+confirmed once its record has been written.
+
+Every accepted answer is written to the journal of the session (see journal.py). When the server is stopped or
+crashes, the sessions of the journals it left behind are restored the next time it starts: respondents continue with
+the same session id at the first question they hadn't answered, completed sessions of which the record wasn't written
+yet are written right away. Sessions that expire after SESSION_TIMEOUT are abandoned along with their journal.
+
+"""
+import asyncio
+import json
+import time
+import uuid
+from datetime import date
+
+import pandas as pd
+
+import ingest
+import journal
+import metrics
+import schema
+import storage
+import targets
+import validation
+
+# The time the writer waits for more completed surveys before writing a batch, and the maximum size of a batch.
+BATCH_DELAY = 0.05
+BATCH_SIZE = 500
+
+# Sessions without any activity for this many seconds are removed.
+SESSION_TIMEOUT = 3600
+
+_REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+
+def _question_payload(question):
+    return {'column': question.column, 'text': question.text, 'measurement_level': question.measurement_level,
+            'goal': question.goal, 'sub_goal': question.sub_goal, 'nested_in': question.nested_in,
+            'prompt': validation.PROMPTS[question.measurement_level]}
+
+
+class SurveyServer:
+    """Holds the sessions and the write queue of a running server."""
+
+    def __init__(self, content, directory='.'):
+        self.content = content
+        self.plan = schema.compile_plan(content)
+        self.directory = directory
+        self.sessions = {}
+        self.queue = None
+
+    # Sessions
+
+    def start_session(self, body=None):
+        try:
+            respondent = json.loads(body or b'{}').get('respondent')
+        except (ValueError, AttributeError):
+            return 400, {'error': 'Expected an empty body or a JSON object with a respondent.'}
+        try:
+            storage.partition_directory(respondent)
+        except ValueError as error:
+            return 400, {'error': str(error)}
+
+        session_id = uuid.uuid4().hex
+        session_journal = journal.open_journal(self.plan, session_id, date.today().isoformat(), self.directory,
+                                               respondent)
+        self.sessions[session_id] = {'journal': session_journal, 'last_seen': time.monotonic()}
+        return 201, {'session': session_id, 'question': _question_payload(session_journal.question)}
+
+    def restore_sessions(self):
+        """Restore the sessions of the journals left behind by an earlier run, see the module documentation.
+
+        :return: The records of the restored sessions that were completed but not yet written, along with their
+                 journals.
+        :rtype: list
+        """
+        completed = []
+        for path in journal.list_journals(self.directory):
+            session_journal = journal.load_journal(path, self.plan, self.directory)
+            if session_journal is None or session_journal.session == journal.TERMINAL_SESSION:
+                continue
+            if session_journal.question is None:
+                completed.append((self._record(session_journal), session_journal))
+            else:
+                self.sessions[session_journal.session] = {'journal': session_journal, 'last_seen': time.monotonic()}
+        return completed
+
+    def current_question(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return 404, {'error': 'Unknown session.'}
+        session['last_seen'] = time.monotonic()
+        return 200, {'session': session_id, 'question': _question_payload(session['journal'].question)}
+
+    async def answer(self, session_id, body):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return 404, {'error': 'Unknown session.'}
+        session['last_seen'] = time.monotonic()
+
+        try:
+            answer = json.loads(body or b'{}')['answer']
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'Expected a JSON body with an answer.'}
+
+        # Step 1: An invalid answer leaves the session at the same question, the prompt explains what is accepted.
+        session_journal = session['journal']
+        question = session_journal.question
+        response = validation.parse_response(question.measurement_level, answer)
+        if response is None:
+            return 200, {'session': session_id, 'accepted': False, 'question': _question_payload(question)}
+
+        # Step 2: A valid answer is journaled and moves the walk on to the next question.
+        question = session_journal.answer(response)
+        if question is not None:
+            return 200, {'session': session_id, 'accepted': True, 'question': _question_payload(question)}
+
+        # Step 3: The survey is completed, the record is confirmed once the writer has stored it. Only then is the
+        # journal removed.
+        del self.sessions[session_id]
+        written = asyncio.get_running_loop().create_future()
+        await self.queue.put((self._record(session_journal), written))
+        await written
+        session_journal.discard()
+        return 200, {'session': session_id, 'accepted': True, 'done': True}
+
+    async def expire_sessions(self):
+        while True:
+            await asyncio.sleep(60)
+            cutoff = time.monotonic() - SESSION_TIMEOUT
+            for session_id in [key for key, session in self.sessions.items() if session['last_seen'] < cutoff]:
+                self.sessions.pop(session_id)['journal'].discard()
+
+    # Writing
+
+    @staticmethod
+    def _record(session_journal):
+        record = session_journal.record()
+        record[storage.SESSION_KEY] = session_journal.key
+        return record
+
+    def _store(self, records):
+        """Store a batch of completed surveys, each tagged with the key of its journal (see storage.session_stored)."""
+        metrics.observe('server_batch_size', len(records))
+        with metrics.span('server.store'):
+            survey_results = pd.DataFrame(records)
+            results = pd.concat([survey_results, targets.generate_targets(survey_results, self.content)], axis=1)
+            ingest.store_results(results, self.plan, self.directory)
+
+    async def write_batches(self):
+        """Drain the queue of completed surveys, storing whatever arrives within BATCH_DELAY in a single batch."""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + BATCH_DELAY
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await loop.run_in_executor(None, self._store, [record for record, _ in batch])
+            except Exception as error:
+                for _, written in batch:
+                    written.set_exception(error)
+            else:
+                for _, written in batch:
+                    written.set_result(True)
+
+    # HTTP
+
+    async def route(self, method, path, body):
+        parts = [part for part in path.split('?')[0].split('/') if part]
+
+        if parts == ['health'] and method == 'GET':
+            return 200, {'status': 'ok', 'sessions': len(self.sessions)}
+        if parts == ['sessions'] and method == 'POST':
+            return self.start_session(body)
+        if len(parts) == 2 and parts[0] == 'sessions' and method == 'GET':
+            return self.current_question(parts[1])
+        if len(parts) == 3 and parts[0] == 'sessions' and parts[2] == 'answer' and method == 'POST':
+            return await self.answer(parts[1], body)
+        if parts and parts[0] in ('health', 'sessions'):
+            return 405, {'error': 'Method not allowed.'}
+        return 404, {'error': 'Not found.'}
+
+    async def handle_connection(self, reader, writer):
+        """Serve the requests on a single connection, which is kept alive unless the client asks to close it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, payload = await self.route(method.upper(), path, body)
+                except Exception as error:
+                    status, payload = 500, {'error': str(error)}
+
+                content = json.dumps(payload).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(content)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') +
+                             content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        completed = self.restore_sessions()
+        if completed:
+            self._store([record for record, _ in completed])
+            for _, session_journal in completed:
+                session_journal.discard()
+        if self.sessions or completed:
+            print(f'Restored {len(self.sessions)} session(s) and stored {len(completed)} completed survey(s) of the '
+                  'previous run.')
+
+        self.queue = asyncio.Queue()
+        background = [asyncio.ensure_future(self.write_batches()), asyncio.ensure_future(self.expire_sessions())]
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        print(f'Serving the survey on http://{host}:{port}, press ctrl+c to stop.')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in background:
+                task.cancel()
+
+
+def run(content, host='127.0.0.1', port=8080, directory='.'):
+    """Run the survey server until interrupted."""
+    try:
+        asyncio.run(SurveyServer(content, directory).serve(host, port))
+    except KeyboardInterrupt:
+        pass
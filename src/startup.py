@@ -0,0 +1,80 @@
+"""
+This document profiles the start of the program (--profile-startup), to keep the time to the first question low.
+
+When enabled, every import from then on is timed. Once the program exits, a report is printed (to stderr) with the
+time spent importing and the slowest imports, next to the moments marked along the way, such as the first question
+being shown in survey mode. Times are measured from the moment profiling is enabled, which main.py does before
+importing anything else. The interpreter's own start up comes on top, use python -X importtime for the full picture.
+
+    import time (ms)      self  cumulative  module
+                          1.2       412.8   pandas
+
+cumulative includes the modules imported by the module itself, self does not.
+
+"""
+import atexit
+import builtins
+import sys
+import threading
+import time
+
+# The number of slowest imports shown in the report.
+REPORT_SIZE = 15
+
+_state = {'start': None, 'imports': [], 'stack': [], 'marks': []}
+_original_import = builtins.__import__
+
+
+def enabled():
+    return _state['start'] is not None
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """Time the import of a module that isn't loaded yet, modules imported while doing so count towards its time. Only
+    imports by the main thread are timed."""
+    if name in sys.modules or threading.current_thread() is not threading.main_thread():
+        return _original_import(name, globals, locals, fromlist, level)
+
+    start = time.perf_counter()
+    _state['stack'].append(0.0)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = time.perf_counter() - start
+        nested = _state['stack'].pop()
+        if _state['stack']:
+            _state['stack'][-1] += cumulative
+        # A relative import (from . import x) has no name of its own, it is reported by what it imports instead.
+        label = name if level == 0 else '.' * level + (name or ', '.join(fromlist or ()))
+        _state['imports'].append((label, len(_state['stack']), cumulative - nested, cumulative))
+
+
+def enable():
+    """Start timing imports and print the report when the program exits."""
+    if enabled():
+        return
+    _state['start'] = time.perf_counter()
+    builtins.__import__ = _timed_import
+    atexit.register(report)
+
+
+def mark(label):
+    """Record the time at which the program reached a given point, does nothing unless profiling is enabled."""
+    if enabled():
+        _state['marks'].append((label, time.perf_counter() - _state['start']))
+
+
+def report(file=None):
+    """Print the time spent importing, the slowest imports and the marked moments."""
+    file = file or sys.stderr
+    imports = _state['imports']
+    top_level = sum(cumulative for _, depth, _, cumulative in imports if depth == 0)
+
+    print('\n=============================== Startup profile ===============================', file=file)
+    print(f'{len(imports)} module(s) imported in {top_level * 1000:.1f} ms', file=file)
+    for label, moment in _state['marks']:
+        print(f'{label}: {moment * 1000:.1f} ms after start', file=file)
+
+    print(f'\n{"import time (ms)":<18}{"self":>8}{"cumulative":>12}  module', file=file)
+    for name, depth, own, cumulative in sorted(imports, key=lambda entry: entry[3], reverse=True)[:REPORT_SIZE]:
+        print(f'{"":<18}{own * 1000:>8.1f}{cumulative * 1000:>12.1f}  {"  " * depth}{name}', file=file)
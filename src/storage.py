@@ -0,0 +1,1049 @@
+"""
+This document acts as the storage layer behind the survey mode.
+
+Every submission used to read the complete yearly file, add a single row to it and write everything back to disk. This
+makes each submission slower as the history grows and a crash halfway through the write could cost a whole year of
+data. Instead, the store consists of two files per year:
+
+    goals_monitoring_<year>.csv: the compacted base, a semicolon separated file as it has always been produced.
+    goals_monitoring_<year>.log: an append-only log holding one JSON record per line for every new submission.
+
+Next to those, goals_monitoring_<year>.index.json holds the number of records per date (and respondent) of the base, as
+well as the session keys of the surveys merged into it (see session_stored), and goals_monitoring_<year>.columns a copy
+of the base in a compact binary format (see columnar.py). Reads use the copy, which is many times faster than parsing
+the base file, as long as it was written for the current base.
+
+A department shares the program by giving every respondent a partition of their own: a directory
+respondents/<respondent>/ holding that respondent's yearly stores, laid out as above. Without a respondent, the stores
+are kept in the working directory itself, as they have always been. Each partition has its own log, base and locks, so
+a respondent's writes and reads never touch the files of anyone else and cost the same however many respondents there
+are. Merges of different partitions run in parallel, see compact_stores.
+
+Appending a record only touches the log, so the cost of a submission stays the same regardless of the amount of
+history. Once the log holds enough records it is merged into the base in the background. Reads include the records
+that are still in the log, so a respondent storing a survey a week reads their own records without ever waiting for
+a merge. During a merge the log is first renamed to a sealed segment, which means new submissions can keep appending
+to a fresh log in the meantime. The name of the sealed segment contains a signature of the base it is merged into,
+this way a merge that was interrupted by a crash can be detected and finished (or cleaned up) the next time the store
+is touched.
+
+Every record in the log holds the hash of the layout of the survey content it was stored in, and the base holds the
+hash of its own layout in its columnar copy and index. The layouts themselves are listed once per directory in
+goals_monitoring.schemas.json. When the content changes, nothing that is stored is rewritten: records of an earlier
+layout are projected onto the current one as they are read (see schema.projection), which only renames and selects
+columns. A merge writes the base in the current layout, answers to questions that were removed are kept in it under
+a name of their own (e.g. sg_1_5_2@3f2a9c01d4e5b6a7) and are left out when reading.
+
+Deleting records works the same way: a tombstone describing the dates (and respondent or other conditions) to delete is
+appended to the log. Tombstones are applied whenever the store is read and the deleted records are dropped for good
+when the log is merged.
+
+Several processes (terminal surveys, imports, the survey server) can write to the same store at once. Writes go through
+a single group commit thread per process: submissions arriving while the previous group is being flushed to disk are
+written together with one flush, and each waits until its own lines are on disk. The log is only written while holding
+an exclusive lock on goals_monitoring_<year>.log.lock and merges are serialised by goals_monitoring_<year>.compact.lock,
+so lines of different writers never interleave and no record is lost to (or duplicated by) a merge running in another
+process. A line cut off by a crash is removed before the next write.
+
+"""
+import os
+import json
+import glob
+import math
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import columnar
+import lazy
+import metrics
+import schema
+import survey_content
+
+np = lazy.module('numpy')
+pd = lazy.module('pandas')
+
+COMPACT_THRESHOLD = 64
+
+# Log entries holding this key are tombstones: deletions that are applied when reading and merging the store.
+TOMBSTONE_KEY = '_tombstone'
+
+# The key under which every record in the log holds the hash of the layout it was stored in.
+SCHEMA_KEY = '_schema'
+
+# The key under which a record in the log holds the key of the journal of the survey session it completed, see
+# journal.py.
+SESSION_KEY = '_session'
+
+# The maximum number of submissions written with a single flush to disk, and the number of times a read is retried
+# when a merge swaps the base while reading.
+GROUP_COMMIT_SIZE = 1000
+READ_ATTEMPTS = 5
+
+# The directory holding a partition (sub directory) per respondent, and the ids a respondent can go by. An id becomes
+# the name of a directory, so it is limited to characters that are safe in file names on every platform.
+PARTITIONS_DIRECTORY = 'respondents'
+RESPONDENT_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.@-]*$')
+
+# The layouts known to be listed in the catalog of a directory, and the projections of the layouts read so far.
+_registered = set()
+_projections = {}
+
+_commit_queue = queue.Queue()
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def _reset_committer():
+    """A forked process (such as an import worker) starts without the writer thread of its parent, nor its queue."""
+    global _commit_queue, _committer, _committer_lock
+    _commit_queue, _committer, _committer_lock = queue.Queue(), None, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_committer)
+
+
+def partition_directory(respondent=None, directory='.'):
+    """Return the directory holding the stores of a respondent, the directory itself when no respondent is given.
+
+    :raises ValueError: When the respondent id is not usable as the name of a directory, see RESPONDENT_ID.
+    """
+    if respondent is None:
+        return directory
+    if not RESPONDENT_ID.match(str(respondent)):
+        raise ValueError(f"Invalid respondent id {str(respondent)!r}, an id consists of letters, digits and '.', '_', "
+                         "'@' or '-' and starts with a letter or digit.")
+    return os.path.join(directory, PARTITIONS_DIRECTORY, str(respondent))
+
+
+def store_stem(year, directory='.', respondent=None):
+    """Return the path, without extension, under which the data of a given year (and respondent) is stored."""
+    return os.path.join(partition_directory(respondent, directory), f'goals_monitoring_{year}')
+
+
+def list_respondents(directory='.'):
+    """Return the ids of the respondents that have a partition in the directory."""
+    try:
+        return sorted(entry.name for entry in os.scandir(os.path.join(directory, PARTITIONS_DIRECTORY))
+                      if entry.is_dir() and RESPONDENT_ID.match(entry.name))
+    except FileNotFoundError:
+        return []
+
+
+def list_stores(directory='.', respondents=None):
+    """List the stores (test data included) in the directory, without opening any of them.
+
+    :param respondents: The respondents of which to list the partitions. Only their directories are looked into, the
+                        number of other respondents makes no difference. None lists the stores without a respondent
+                        followed by those of every respondent.
+
+    :return: (stem, respondent) tuples, the respondent being None for the stores without one.
+    :rtype: list
+    """
+    if respondents is None:
+        partitions = [None] + list_respondents(directory)
+    else:
+        partitions = [str(respondent) for respondent in respondents]
+
+    stores = []
+    for respondent in partitions:
+        partition = glob.escape(partition_directory(respondent, directory))
+        stems = {os.path.splitext(path)[0] for path in glob.glob(os.path.join(partition, '*goals_monitoring_*.csv')) +
+                 glob.glob(os.path.join(partition, '*goals_monitoring_*.log'))}
+        stores.extend((stem, respondent) for stem in sorted(stems))
+    return stores
+
+
+def base_path(stem):
+    return f'{stem}.csv'
+
+
+def log_path(stem):
+    return f'{stem}.log'
+
+
+def index_path(stem):
+    return f'{stem}.index.json'
+
+
+def columns_path(stem):
+    return f'{stem}.columns'
+
+
+def lock_path(stem, purpose='log'):
+    return f'{stem}.{purpose}.lock'
+
+
+def schemas_path(stem):
+    """Return the path of the catalog of layouts, shared by the stores in the same directory."""
+    return os.path.join(os.path.dirname(stem), 'goals_monitoring.schemas.json')
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a file for the duration of the with block.
+
+    The lock works across processes as well as across threads within a process, as every holder opens the lock file
+    separately.
+    """
+    with open(path, 'a+b') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def store_exists(stem):
+    return os.path.exists(base_path(stem)) or os.path.exists(log_path(stem))
+
+
+def _base_signature(stem):
+    """Describe the current base file by its size and modification time, 'none' if there is no base yet."""
+    try:
+        stat = os.stat(base_path(stem))
+    except FileNotFoundError:
+        return 'none'
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def _sealed_segments(stem):
+    """Return all sealed log segments as (path, base signature) tuples."""
+    segments = []
+    for path in sorted(glob.glob(f'{glob.escape(log_path(stem))}.*.merging')):
+        signature = path[len(log_path(stem)) + 1:].split('.')[0]
+        segments.append((path, signature))
+    return segments
+
+
+def _to_json_value(value):
+    """Convert the values found in a survey record to something the json module is able to serialize."""
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, 'item') and hasattr(value, 'dtype'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def append_record(record, stem, session=None):
+    """Append a single survey record to the log of the store.
+
+    The record is written as one line of JSON and flushed to disk before returning, the base file is never touched.
+    After appending, a background merge is started once the log holds COMPACT_THRESHOLD records or more.
+
+    :param record: A dictionary with a value for each column, as produced by start_survey and generate_targets.
+    :param stem: The path of the store, as returned by store_stem.
+    :param session: The key of the survey session the record completes, see session_stored.
+
+    :return: The background merge thread if one was started, else None.
+    """
+    plan = _register_layout(stem)
+    record = dict({key: _to_json_value(value) for key, value in record.items()}, **{SCHEMA_KEY: plan.schema_hash})
+    if session is not None:
+        record[SESSION_KEY] = session
+    line = json.dumps(record) + '\n'
+    return _append_lines(line, stem)
+
+
+def append_records(records, stem, merge=True):
+    """Append many records to the log of the store at once, with a single write and flush.
+
+    :param records: A DataFrame with one row per record, the date column holding ISO formatted dates. A SESSION_KEY
+                    column holds the key of the survey session of each record, see session_stored.
+    :param stem: The path of the store, as returned by store_stem.
+    :param merge: Whether a background merge may be started, bulk writers can turn this off and call compact once
+                  they are done.
+
+    :return: The background merge thread if one was started, else None.
+    """
+    if records.empty:
+        return None
+    plan = _register_layout(stem)
+    lines = records.assign(**{SCHEMA_KEY: plan.schema_hash}).to_json(orient='records', lines=True,
+                                                                    date_format='iso').rstrip('\n') + '\n'
+    return _append_lines(lines, stem, merge)
+
+
+def _append_lines(lines, stem, merge=True):
+    """Hand lines to the group commit writer and wait until they are safely on disk."""
+    global _committer
+
+    with _committer_lock:
+        if _committer is None or not _committer.is_alive():
+            _committer = threading.Thread(target=_commit_loop, name='group-commit', daemon=True)
+            _committer.start()
+
+    entry = {'lines': lines, 'stem': stem, 'merge': merge, 'done': threading.Event(), 'error': None, 'thread': None}
+    _commit_queue.put(entry)
+    entry['done'].wait()
+
+    if entry['error'] is not None:
+        raise entry['error']
+    return entry['thread']
+
+
+def _commit_loop():
+    """Write everything waiting in the commit queue, one write and flush to disk per store.
+
+    While a group is being flushed, new submissions pile up in the queue and are committed together in the next round.
+    The more submissions arrive at once, the more of them share a single flush.
+    """
+    while True:
+        batch = [_commit_queue.get()]
+        while len(batch) < GROUP_COMMIT_SIZE:
+            try:
+                batch.append(_commit_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        by_stem = {}
+        for entry in batch:
+            by_stem.setdefault(entry['stem'], []).append(entry)
+
+        for stem, entries in by_stem.items():
+            metrics.observe('storage_commit_group_size', len(entries))
+            try:
+                thread = _commit(stem, ''.join(entry['lines'] for entry in entries),
+                                 any(entry['merge'] for entry in entries))
+                for entry in entries:
+                    entry['thread'] = thread
+            except Exception as error:
+                for entry in entries:
+                    entry['error'] = error
+            for entry in entries:
+                entry['done'].set()
+
+
+def _commit(stem, lines, merge):
+    """Append lines to the log while holding the log lock, so no other process writes or seals it meanwhile. The first
+    write to the partition of a new respondent creates its directory."""
+    os.makedirs(os.path.dirname(stem) or '.', exist_ok=True)
+    with metrics.span('storage.commit'), file_lock(lock_path(stem)):
+        recover(stem)
+        with metrics.span('storage.write'), open(log_path(stem), 'a', encoding='utf-8') as log:
+            log.write(lines)
+            log.flush()
+            os.fsync(log.fileno())
+            size = log.tell()
+
+    # The size check keeps this cheap, only when the log is large enough are the lines actually counted.
+    line_length = len(lines) / max(lines.count('\n'), 1)
+    if merge and size >= COMPACT_THRESHOLD * line_length and _count_lines(log_path(stem)) >= COMPACT_THRESHOLD:
+        return compact_in_background(stem)
+
+    return None
+
+
+def recover(stem):
+    """Remove a partially written last line from the log, left behind when a process crashed while writing.
+
+    Without this, the next record would be appended to the broken line and be lost along with it. The caller should
+    hold the log lock.
+    """
+    try:
+        with open(log_path(stem), 'rb+') as log:
+            end = log.seek(0, os.SEEK_END)
+            if end == 0:
+                return
+            log.seek(end - 1)
+            if log.read(1) == b'\n':
+                return
+
+            # Search backwards for the end of the last complete line.
+            position = end
+            while position > 0:
+                block = min(4096, position)
+                log.seek(position - block)
+                newline = log.read(block).rfind(b'\n')
+                if newline >= 0:
+                    position = position - block + newline + 1
+                    break
+                position -= block
+            log.truncate(max(position, 0))
+            log.flush()
+            os.fsync(log.fileno())
+    except FileNotFoundError:
+        pass
+
+
+def session_stored(stem, session):
+    """Whether the record of a survey session was stored, which tells whether a session that was interrupted right
+    after storing its record got that far (see journal.py).
+
+    The log is searched first, then its sealed segments and then the session keys that the index keeps of the merged
+    records. A merge seals the log before writing the index and only removes the segments after, so a record that is
+    being merged meanwhile is always found in one of the three.
+    """
+    return (session in _logged_sessions([log_path(stem)] + [path for path, _ in _sealed_segments(stem)]) or
+            session in _index_sessions(stem))
+
+
+def _logged_sessions(paths):
+    """Return the session keys of the records in the given logs (or sealed segments), see append_record."""
+    sessions = set()
+    for path in paths:
+        try:
+            with open(path, encoding='utf-8') as log:
+                for line in log:
+                    if SESSION_KEY not in line:
+                        continue
+                    try:
+                        session = json.loads(line).get(SESSION_KEY)
+                    except json.JSONDecodeError:
+                        continue
+                    if session is not None:
+                        sessions.add(session)
+        except FileNotFoundError:
+            # A merge removed the segment, after writing its records and their session keys to the base.
+            continue
+    return sessions
+
+
+def _count_lines(path):
+    try:
+        with open(path, 'rb') as file:
+            return sum(1 for _ in file)
+    except FileNotFoundError:
+        # The log has just been sealed by a merge running in the background.
+        return 0
+
+
+def _read_log(path, stem, drop=True):
+    """Read a log (or sealed segment), a partially written last line is ignored. Records stored in an earlier layout
+    are projected onto the current one.
+
+    :param drop: Whether to leave out the answers without a place in the current layout, see schema.project.
+
+    :return: The records as a DataFrame and the tombstones as (position, tombstone) tuples, where position is the
+             number of records in the log that precede the tombstone.
+    :rtype: tuple
+    """
+    current = _plan().schema_hash
+    projections = {}
+    records = []
+    tombstones = []
+    with open(path, encoding='utf-8') as log:
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if TOMBSTONE_KEY in entry:
+                tombstones.append((len(records), entry[TOMBSTONE_KEY]))
+                continue
+            version = entry.pop(SCHEMA_KEY, None)
+            entry.pop(SESSION_KEY, None)
+            if version != current:
+                if version not in projections:
+                    projections[version] = _projection(stem, version)
+                entry = schema.project_record(entry, projections[version], drop)
+            records.append(entry)
+
+    # Columns that were skipped in every record come back as None, these are turned into NaN like pd.read_csv does.
+    frame = pd.DataFrame.from_records(records)
+    empty_columns = frame.columns[frame.isna().all()]
+    frame[empty_columns] = frame[empty_columns].astype(float)
+    return frame, tombstones
+
+
+def _plan():
+    return schema.compile_plan(survey_content)
+
+
+def _read_catalog(stem):
+    try:
+        with open(schemas_path(stem), encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _register_layout(stem, layout=None, version=None):
+    """List a layout (by default that of the current content) in the catalog of the directory of the store, which has
+    to happen before anything is stored in it.
+
+    :return: The compiled current content.
+    :rtype: schema.Plan
+    """
+    plan = _plan()
+    layout, version = (plan.layout, plan.schema_hash) if layout is None else (layout, version)
+    if (schemas_path(stem), version) in _registered:
+        return plan
+
+    os.makedirs(os.path.dirname(stem) or '.', exist_ok=True)
+    with file_lock(lock_path(os.path.join(os.path.dirname(stem), 'goals_monitoring'), 'schemas')):
+        catalog = _read_catalog(stem)
+        if version not in catalog:
+            catalog[version] = {'first_used': date.today().isoformat(), 'layout': layout}
+            temp_path = f'{schemas_path(stem)}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as temp:
+                json.dump(catalog, temp, indent=1)
+            os.replace(temp_path, schemas_path(stem))
+    _registered.add((schemas_path(stem), version))
+    return plan
+
+
+def _projection(stem, version):
+    """Return how the records stored in a given layout are read in the current one, None when nothing changes.
+
+    :param version: The hash of the layout, None for records stored before layouts were recorded.
+    """
+    plan = _plan()
+    version = version or schema.UNVERSIONED
+    key = (schemas_path(stem), version, plan.schema_hash)
+    if key not in _projections:
+        stored = _read_catalog(stem).get(version)
+        _projections[key] = schema.projection(plan, stored['layout'] if stored else None,
+                                              getattr(survey_content, 'schema_changes', {}).get(version), version)
+    return _projections[key]
+
+
+def _base_schema(stem, table=None):
+    """Return the layout of the base as recorded by its columnar copy or else its index, None when unknown."""
+    if table is not None:
+        return table.schema
+    try:
+        with open(index_path(stem), encoding='utf-8') as file:
+            index = json.load(file)
+        if index['signature'] == _base_signature(stem):
+            return index.get('schema')
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    return None
+
+
+def _column_dtypes():
+    """The preferred type of every column in the columnar file, following the measurement levels of the content."""
+    plan = _plan()
+    return {column: 'bits' if plan.level_of.get(column) == 'yes_no' else dtype for column, dtype in plan.dtypes.items()}
+
+
+def _open_columns(stem):
+    """Open the columnar copy of the base, None when it is missing or no longer matches the base."""
+    return columnar.open_file(columns_path(stem), _base_signature(stem))
+
+
+def _stored_columns(projection, wanted=None, drop=True):
+    """Return a function telling whether to read a stored column, given the columns wanted in the current layout.
+
+    :param wanted: A function telling whether a column of the current layout is wanted, None for all columns.
+    """
+    def read(column):
+        name = schema.projected_name(projection, column, drop)
+        return name is not None and (wanted is None or wanted(name))
+    return read
+
+
+def _read_base(stem, usecols=None, typed=False, drop=True):
+    """Read the base, from its columnar copy when that is up to date and from the base file itself otherwise. The
+    records are projected onto the current layout.
+
+    :param usecols: A function telling whether to read a column (of the current layout).
+    :param typed: Whether to return the compact types of the columnar file, see columnar.py.
+    :param drop: Whether to leave out the answers without a place in the current layout, see schema.project.
+    """
+    table = _open_columns(stem)
+    projection = _projection(stem, _base_schema(stem, table))
+    read = _stored_columns(projection, usecols, drop)
+
+    if table is not None:
+        return schema.project(table.to_frame([column for column in table.columns if read(column)], typed=typed),
+                              projection, drop)
+
+    try:
+        frame = pd.read_csv(base_path(stem), sep=';', index_col=0,
+                            usecols=lambda column: column == '' or column.startswith('Unnamed: ') or read(column))
+    except FileNotFoundError:
+        return pd.DataFrame()
+
+    # Files written by older versions of the deletion mode gained an extra index column with every deletion.
+    frame = frame.drop(columns=[column for column in frame.columns if column.startswith('Unnamed: ')])
+    frame = schema.project(frame, projection, drop)
+    return columnar.to_typed(frame, _column_dtypes()) if typed else frame
+
+
+def _read_pending(stem, drop=True, include_log=True):
+    """Read everything that has not been merged into the base yet, see _read_log for drop.
+
+    :param include_log: Whether to read the live log besides the sealed segments. A merge only reads the segments it
+                        sealed, records appended to the fresh log meanwhile are left for the next merge.
+
+    :return: The pending records and their tombstones, with positions counted over all pending records.
+    :rtype: tuple
+    """
+    signature = _base_signature(stem)
+    paths = [path for path, segment_signature in _sealed_segments(stem) if segment_signature == signature]
+    if include_log and os.path.exists(log_path(stem)):
+        paths.append(log_path(stem))
+
+    frames = []
+    tombstones = []
+    offset = 0
+    for path in paths:
+        frame, log_tombstones = _read_log(path, stem, drop)
+        tombstones.extend((offset + position, tombstone) for position, tombstone in log_tombstones)
+        offset += len(frame)
+        if not frame.empty:
+            frames.append(frame)
+
+    pending = pd.concat(frames, axis=0, ignore_index=True) if frames else pd.DataFrame()
+    return pending, tombstones
+
+
+def _matches(frame, tombstone):
+    """Return a boolean mask of the records in the frame that are deleted by the tombstone."""
+    mask = np.ones(len(frame), dtype=bool)
+    if tombstone.get('date_from'):
+        mask &= (frame['date'] >= tombstone['date_from']).to_numpy()
+    if tombstone.get('date_to'):
+        mask &= (frame['date'] <= tombstone['date_to']).to_numpy()
+    if tombstone.get('respondent') is not None:
+        if 'respondent' not in frame:
+            return np.zeros(len(frame), dtype=bool)
+        mask &= (frame['respondent'].astype(str) == str(tombstone['respondent'])).to_numpy()
+    if tombstone.get('where'):
+        # A condition that can't be evaluated (e.g. on a column the store doesn't have) deletes nothing, rather than
+        # making the store unreadable.
+        try:
+            mask &= _evaluate(frame, tombstone['where'])
+        except ValueError:
+            return np.zeros(len(frame), dtype=bool)
+    return mask
+
+
+def _evaluate(frame, where):
+    """Evaluate a condition on the records of a frame.
+
+    :raises ValueError: When the condition can't be evaluated or doesn't result in a value per record.
+    """
+    try:
+        result = frame.eval(where)
+        if not isinstance(result, pd.Series) or len(result) != len(frame):
+            raise ValueError('it does not result in a value per record')
+        return result.fillna(False).to_numpy(dtype=bool)
+    except Exception as error:
+        raise ValueError(f'Invalid condition {where!r}: {error}') from error
+
+
+def check_condition(stem, where):
+    """Check that a condition can be evaluated on the records of a store, before it is used to delete records. Next to
+    the columns of the store, the columns of the current content are allowed.
+
+    :raises ValueError: When it can't be evaluated, see _evaluate.
+    """
+    columns = store_columns(stem)
+    columns += [column for column in _plan().record_columns + schema.RECORD_KEYS if column not in columns]
+    _evaluate(pd.DataFrame({column: pd.Series(dtype=object if column in schema.RECORD_KEYS else float)
+                            for column in columns}), where)
+
+
+def _apply_tombstones(frame, tombstones, offset):
+    """Drop the records deleted by the tombstones, a tombstone only applies to the records written before it.
+
+    :param offset: The number of base records at the start of the frame, which precede every tombstone.
+    """
+    if not tombstones or frame.empty:
+        return frame
+
+    keep = np.ones(len(frame), dtype=bool)
+    for position, tombstone in tombstones:
+        end = offset + position
+        keep[:end] &= ~_matches(frame.iloc[:end], tombstone)
+
+    return frame[keep].reset_index(drop=True)
+
+
+def _combine(base, pending, tombstones):
+    frames = [frame for frame in (base, pending) if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    return _apply_tombstones(pd.concat(frames, axis=0, ignore_index=True), tombstones, len(base))
+
+
+def _consistent(stem, read):
+    """Run a read of base and log, retrying when a merge (possibly by another process) changed the store meanwhile.
+
+    A merge swaps the base and removes the sealed segments, a read overlapping with it could see the records of a
+    segment twice or not at all. When the store keeps changing, the read waits for the merge to finish instead.
+    """
+    for _ in range(READ_ATTEMPTS):
+        signature = _base_signature(stem)
+        try:
+            result = read()
+        except FileNotFoundError:
+            continue
+        if _base_signature(stem) == signature:
+            return result
+
+    with file_lock(lock_path(stem, 'compact')):
+        return read()
+
+
+def read_records(stem, typed=False):
+    """Read all records of the store, the compacted base followed by everything that has not been merged yet.
+
+    :param stem: The path of the store, as returned by store_stem.
+    :param typed: Whether to return the columns in their compact types (see columnar.py) instead of the float64 and
+                  text columns of the base file.
+
+    :return: All records that have not been deleted, in the order in which they were submitted.
+    :rtype: Pandas DataFrame
+    """
+    def read():
+        pending, tombstones = _read_pending(stem)
+        if typed and not pending.empty:
+            pending = columnar.to_typed(pending, _column_dtypes())
+        return _combine(_read_base(stem, typed=typed), pending, tombstones)
+
+    with metrics.span('storage.read'):
+        return _consistent(stem, read)
+
+
+def store_columns(stem):
+    """Return the columns of the store without reading the base records, only its header."""
+    columns = []
+    table = _open_columns(stem)
+    if table is not None:
+        columns = table.columns
+    elif os.path.exists(base_path(stem)):
+        columns = [column for column in pd.read_csv(base_path(stem), sep=';', index_col=0, nrows=0).columns
+                   if not column.startswith('Unnamed: ')]
+    projection = _projection(stem, _base_schema(stem, table))
+    columns = [name for name in (schema.projected_name(projection, column) for column in columns) if name is not None]
+    columns += [column for column in projection.defaults if column not in columns] if projection else []
+    pending, _ = _read_pending(stem)
+    return columns + [column for column in pending.columns if column not in columns]
+
+
+def scan_records(stem, columns=None, chunk_size=100_000, typed=False):
+    """Read the records of the store in chunks, with only the requested columns.
+
+    The base is read chunk by chunk, followed by the records that have not been merged yet. Deleted records are left
+    out. Tombstones with a condition on the answers need every column of a record, when such a tombstone is pending
+    the base is read in full before selecting the columns.
+
+    :param stem: The path of the store, as returned by store_stem.
+    :param columns: The columns to read, None for all columns. Columns missing from (part of) the store are left out.
+    :param chunk_size: The number of base records read at a time.
+    :param typed: Whether to return the columns in their compact types, see columnar.py.
+
+    :return: A generator of DataFrames.
+    """
+    pending, tombstones = _read_pending(stem)
+    needed = None if columns is None or any(tombstone.get('where') for _, tombstone in tombstones) else \
+        set(columns) | {'date', 'respondent'}
+
+    def select(frame):
+        return frame if columns is None else frame[[column for column in columns if column in frame.columns]]
+
+    # Step 1: All base records precede every tombstone, so each tombstone applies to every base chunk. The columnar
+    # copy of the base is read a range of rows at a time, the base file itself is only parsed when the copy is stale.
+    # Either way, only the stored columns needed for the requested columns of the current layout are read.
+    table = _open_columns(stem)
+    projection = _projection(stem, _base_schema(stem, table))
+    read = _stored_columns(projection, None if needed is None else needed.__contains__)
+    if table is not None:
+        selected = [column for column in table.columns if read(column)]
+        chunks = (schema.project(table.to_frame(selected, start, start + chunk_size, typed), projection)
+                  for start in range(0, table.rows, chunk_size))
+    elif os.path.exists(base_path(stem)):
+        chunks = pd.read_csv(base_path(stem), sep=';', index_col=0, chunksize=chunk_size,
+                             usecols=lambda column: column == '' or column.startswith('Unnamed: ') or read(column))
+        chunks = (schema.project(chunk.drop(columns=[column for column in chunk.columns
+                                                     if column.startswith('Unnamed: ')]), projection)
+                  for chunk in chunks)
+        if typed:
+            chunks = (columnar.to_typed(chunk, _column_dtypes()) for chunk in chunks)
+    else:
+        chunks = []
+
+    for chunk in chunks:
+        deleted = np.zeros(len(chunk), dtype=bool)
+        for _, tombstone in tombstones:
+            deleted |= _matches(chunk, tombstone)
+        yield select(chunk[~deleted])
+
+    # Step 2: Pending tombstones only apply to the pending records written before them.
+    if not pending.empty:
+        pending = _apply_tombstones(pending, tombstones, 0)
+        yield select(columnar.to_typed(pending, _column_dtypes()) if typed else pending)
+
+
+def delete_records(stem, date_from=None, date_to=None, respondent=None, where=None):
+    """Delete records by appending a tombstone to the log.
+
+    The records are only hidden from reads, they are removed from the base file the next time the store is merged.
+    All given conditions have to match for a record to be deleted.
+
+    :param stem: The path of the store, as returned by store_stem.
+    :param date_from: The first date (ISO formatted, inclusive) to delete.
+    :param date_to: The last date (ISO formatted, inclusive) to delete.
+    :param respondent: Only delete the records of this respondent.
+    :param where: A condition on the columns of a record, as accepted by DataFrame.query, e.g. 'sg_1_1_1 == 0'. Check it
+                  with check_condition first, a condition that can't be evaluated deletes nothing.
+    """
+    if date_from is None and date_to is None and respondent is None and where is None:
+        raise ValueError('At least one condition is required to delete records.')
+
+    tombstone = {'date_from': date_from, 'date_to': date_to, 'respondent': respondent, 'where': where}
+    return _append_lines(json.dumps({TOMBSTONE_KEY: tombstone}) + '\n', stem)
+
+
+def _index_keys(columns):
+    return [column for column in ('date', 'respondent') if column in columns]
+
+
+def _build_index(frame):
+    """Count the records per date (and respondent)."""
+    if frame.empty:
+        return pd.DataFrame(columns=['date', 'records'])
+    keys = _index_keys(frame.columns)
+    return frame.groupby(keys).size().rename('records').reset_index()
+
+
+def _write_index(stem, frame, version=None):
+    """Write the index of the base. Besides the number of records per date, it keeps the session keys of the merged
+    records (see session_stored): those of the earlier index and of the segments merged into the current base."""
+    index = _build_index(frame)
+    signature = _base_signature(stem)
+    temp_path = f'{index_path(stem)}.tmp'
+    if version is None:
+        version = _base_schema(stem, _open_columns(stem))
+
+    # The segments are read before the earlier index: a merge only removes them after writing its index.
+    merged = [path for path, segment_signature in _sealed_segments(stem) if segment_signature != signature]
+    sessions = _logged_sessions(merged) | _index_sessions(stem)
+    with open(temp_path, 'w', encoding='utf-8') as temp:
+        json.dump({'signature': signature, 'schema': version, 'columns': list(index.columns),
+                   'rows': index.to_numpy().tolist(), 'sessions': sorted(sessions)}, temp, default=str)
+    os.replace(temp_path, index_path(stem))
+
+
+def _index_sessions(stem):
+    """Return the session keys of the records merged into the base, as kept by its index."""
+    try:
+        with open(index_path(stem), encoding='utf-8') as file:
+            return set(json.load(file).get('sessions', []))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return set()
+
+
+def _read_base_index(stem):
+    """Read the index of the base, it is rebuilt from the date (and respondent) column if it is missing or stale."""
+    try:
+        with open(index_path(stem), encoding='utf-8') as file:
+            index = json.load(file)
+        if index['signature'] == _base_signature(stem):
+            return pd.DataFrame(index['rows'], columns=index['columns'])
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    if not os.path.exists(base_path(stem)):
+        return pd.DataFrame(columns=['date', 'records'])
+
+    base = _read_base(stem, usecols=lambda column: column in ('date', 'respondent') or column.startswith('Unnamed: '))
+    _write_index(stem, base)
+    return _build_index(base)
+
+
+def date_index(stem):
+    """Return the number of records per date (and respondent, when stored), without reading the full base.
+
+    :param stem: The path of the store, as returned by store_stem.
+
+    :return: The columns date, respondent (if present) and records, sorted by date.
+    :rtype: Pandas DataFrame
+    """
+    def read():
+        pending, tombstones = _read_pending(stem)
+
+        # A tombstone with a condition on the answers can only be applied to full records.
+        if any(tombstone.get('where') for _, tombstone in tombstones):
+            return _build_index(_combine(_read_base(stem), pending, tombstones))
+
+        base = _read_base_index(stem)
+        if not pending.empty:
+            pending = pending[_index_keys(pending.columns)].assign(records=1)
+        index = _combine(base, pending, tombstones)
+        if not index.empty:
+            index = index.groupby(_index_keys(index.columns))['records'].sum().reset_index()
+        return index
+
+    index = _consistent(stem, read)
+    return index.sort_values('date').reset_index(drop=True) if not index.empty else index
+
+
+def _layout_of(stem, frame):
+    """Return the hash of the layout of records about to become the base, after listing it in the catalog.
+
+    Records in the current layout get the hash of the current content. Answers kept from earlier layouts (see
+    schema.project) extend that layout with columns holding no question.
+    """
+    plan = _plan()
+    known = set(plan.record_columns) | set(schema.RECORD_KEYS)
+    extra = [column for column in frame.columns if column not in known]
+    if not extra:
+        return _register_layout(stem).schema_hash
+
+    layout = plan.layout + [[column, None] for column in extra]
+    version = schema.layout_hash(layout)
+    _register_layout(stem, layout, version)
+    return version
+
+
+def _write_base(stem, frame):
+    """Write a temporary file next to the base and atomically swap it in, after which the columnar copy and the index
+    are updated. Both hold the signature of the new base, so until they are written they are simply ignored. The
+    layout of the records is recorded in both."""
+    version = _layout_of(stem, frame)
+    temp_path = f'{base_path(stem)}.tmp'
+    with open(temp_path, 'w', encoding='utf-8', newline='') as temp:
+        frame.to_csv(temp, sep=';')
+        temp.flush()
+        os.fsync(temp.fileno())
+    os.replace(temp_path, base_path(stem))
+    columnar.write(columns_path(stem), frame, _column_dtypes(), _base_signature(stem), version)
+    _write_index(stem, frame, version)
+
+
+def replace_records(stem, frame):
+    """Replace the compacted base with the given records.
+
+    This is meant for maintenance on the full history (such as recomputing targets) and should follow a call to
+    compact, records still in the log are left untouched.
+    """
+    os.makedirs(os.path.dirname(stem) or '.', exist_ok=True)
+    with file_lock(lock_path(stem, 'compact')):
+        _write_base(stem, frame.reset_index(drop=True))
+
+
+def rewrite_records(stem, transform):
+    """Merge the log into the base and rewrite every merged record, as a single step.
+
+    The merge and the rewrite happen under the same lock, so no other merge can slip in between. Records appended to
+    the log in the meantime are left in the log, they are not rewritten.
+
+    :param transform: A function receiving the records of the base as a DataFrame and returning them rewritten.
+
+    :return: Whether there were any records to rewrite.
+    """
+    with file_lock(lock_path(stem, 'compact')):
+        _merge(stem)
+        if not os.path.exists(base_path(stem)):
+            return False
+        _write_base(stem, transform(_read_base(stem, drop=False)).reset_index(drop=True))
+        return True
+
+
+def compact(stem):
+    """Merge the log into the base file.
+
+    Step 1 seals the current log by renaming it, after which new records end up in a fresh log. Step 2 writes the base
+    plus the sealed segments (never the fresh log), with the deleted records removed, to a temporary file which
+    atomically replaces the base. Step 3 removes the merged segments and with them the tombstones. When the process
+    is interrupted before step 2 finishes, the base is still intact and the segments are picked up again on the next
+    merge. If it is interrupted after, the changed base signature shows that the segments are already merged.
+
+    Only one merge of a store runs at a time, across processes. The log lock is only held while sealing, so writers
+    are never blocked for the duration of a merge.
+
+    :param stem: The path of the store, as returned by store_stem.
+    """
+    with file_lock(lock_path(stem, 'compact')):
+        _merge(stem)
+
+
+def _merge(stem):
+    """Merge the log into the base, see compact. The caller should hold the compact lock."""
+    signature = _base_signature(stem)
+
+    # Step 1: Seal the log, as well as clean up segments left behind by an interrupted merge. Their records are part of
+    # the base already, its index is brought up to date first to take over their session keys.
+    merged = [path for path, segment_signature in _sealed_segments(stem) if segment_signature != signature]
+    if merged:
+        _read_base_index(stem)
+    for path in merged:
+        os.remove(path)
+
+    with file_lock(lock_path(stem)):
+        if os.path.exists(log_path(stem)):
+            recover(stem)
+            os.replace(log_path(stem), f'{log_path(stem)}.{signature}.{time.time_ns()}.merging')
+
+    segments = [path for path, _ in _sealed_segments(stem)]
+    if not segments:
+        return
+
+    # Step 2: Write the merged data next to the base and swap it in. Records of earlier layouts are brought into
+    # the current one, without leaving out any answer.
+    with metrics.span('storage.compact.read'):
+        pending, tombstones = _read_pending(stem, drop=False, include_log=False)
+        base = _read_base(stem, drop=False)
+    with metrics.span('storage.compact.combine'):
+        merged = _combine(base, pending, tombstones)
+    with metrics.span('storage.compact.write'):
+        _write_base(stem, merged)
+
+    # Step 3: The segments are now part of the base and can be removed.
+    for path in segments:
+        os.remove(path)
+
+
+def compact_in_background(stem):
+    """Start a merge of the log into the base in a separate thread.
+
+    The thread is not a daemon, meaning the program will wait for the merge to complete before exiting.
+    """
+    lazy.load(np)
+    lazy.load(pd)
+    thread = threading.Thread(target=compact, args=(stem,), name=f'compact-{os.path.basename(stem)}')
+    thread.start()
+    return thread
+
+
+def compact_stores(stems, workers=1):
+    """Merge the logs of several stores, such as the partitions of all respondents, in a pool of processes.
+
+    Every store has locks of its own, so the merges don't wait for one another and a merge in one partition never
+    holds up a respondent writing to another.
+
+    :param stems: The paths of the stores, as returned by store_stem.
+    :param workers: The number of processes merging stores, 1 merges them one after another in the current process.
+    """
+    stems = list(stems)
+    if workers <= 1 or len(stems) <= 1:
+        for stem in stems:
+            compact(stem)
+        return
+
+    # Only imported here, importing it takes longer than a survey needs to store its record.
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(stems))) as executor:
+        for _ in executor.map(compact, stems):
+            pass
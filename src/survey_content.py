@@ -16,6 +16,10 @@ There are 4 measurement levels:
 
 The measurement level is used later in requesting a response from the respondent
 
+Lastly, target_goals, level_targets and goal_targets define for which goals a target is generated and what that target
+is, either per measurement level or for a specific goal. schema_changes describes how answers stored under an earlier
+version of this document are read after changing it.
+
 """
 overarching_goals = [
     """“Generate intuitive understanding of our data where I am able to clearly and comprehensively explain the data and
@@ -89,3 +93,28 @@ questions_by_subgoals = {'og_1_1': [
          ],
     ]
 }
+
+# Targets are generated for every goal in target_goals. The target of a goal is looked up in goal_targets first, if it
+# isn't listed there the target belonging to its measurement level in level_targets is used. When a goal was skipped
+# (answered with 0 or not asked at all) the target is 0.
+target_goals = ['sg_2_1_1', 'sg_2_2_2', 'sg_2_3_1', 'sg_2_4_1_python', 'sg_2_4_1_sql', 'sg_2_4_1_tableau',
+                'sg_2_4_1_powerpoint', 'gnrl_1', 'gnrl_2', 'gnrl_3']
+
+level_targets = {
+    'likert_5': 3,
+    'scale_10': 6,
+    'yes_no': 1
+}
+
+goal_targets = {}
+
+# Records stored under an earlier version of this document are read in the current columns by matching every column on
+# its question (see schema.projection): questions that moved to another position are found by their text, removed
+# questions are left out. Anything else is listed here, by the hash of the earlier layout. The hash of every layout
+# used so far can be found in goals_monitoring.schemas.json. For example:
+#     '3f2a9c01d4e5b6a7': {
+#         'renames': {'sg_1_5_2': 'sg_1_5_1'},  # an answer now belonging to another question
+#         'defaults': {'sg_2_2_2': 0},  # the answer to assume for a question that was added later
+#         'drops': ['sg_1_3_2'],  # a question replaced by a different one of the same measurement level
+#     }
+schema_changes = {}
@@ -0,0 +1,179 @@
+"""
+This document generates synthetic survey data for load and dashboard testing (test mode).
+
+Instead of building the data one week and one question at a time, every measurement level is generated as a complete
+NumPy column in one go. The output is produced in chunks of a fixed number of rows which are appended to the output
+file one after another, this way the memory used stays the same no matter how many rows are requested.
+
+Skipped questions are simulated the same way prompt_questions produces them: when a respondent answers 0 to a question
+of a sub goal, that answer and the remaining questions of that sub goal end up empty (NaN), as they are never asked.
+
+Data of several respondents is either written to a single file with a respondent column, or split over the partitions
+of the respondents (see storage.py), the way their own answers are stored.
+
+"""
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+import storage
+
+# The range (inclusive) of random values generated for every measurement level.
+VALUE_RANGES = {
+    'likert_5': (1, 5),
+    'scale_10': (1, 10),
+    'quantity': (1, 15),
+    'yes_no': (0, 1),
+}
+
+WEEKS_PER_YEAR = 52
+
+
+def _skip_groups(plan, skippable_only=False):
+    """Group the columns that are skipped together, being the questions of a sub goal. Nested elements and general
+    goals are never skipped by prompt_questions, each of them forms a group of its own, unless skippable_only is set
+    in which case they are left out."""
+    groups = {}
+    for question in plan.questions:
+        if question.nested_in is None and question.sub_goal_key != 'gnrl':
+            groups.setdefault(question.sub_goal_key, []).append(question.column)
+        elif not skippable_only:
+            groups[question.column] = [question.column]
+    return list(groups.values())
+
+
+def generate_chunk(plan, rng, offset, size, respondents=1, years=1, skip_rate=0.0, start_date=None,
+                   respondent_ids=None):
+    """Generate a block of random survey records.
+
+    Row number r (counted over the whole data set) belongs to respondent r % respondents and is dated on week
+    (r // respondents) % (52 * years) counting from the start date. This way each respondent gets one record a week and
+    the weeks wrap around after the requested number of years.
+
+    :param plan: The compiled survey content, see schema.compile_plan.
+    :param rng: A NumPy random Generator.
+    :param offset: The row number of the first row in this chunk.
+    :param size: The number of rows in this chunk.
+    :param respondents: The number of respondents, when larger than 1 a respondent column is added.
+    :param years: The number of years the weekly dates are spread over.
+    :param skip_rate: The chance a respondent skips the (remainder of) a sub goal.
+    :param start_date: The date of the first week, defaults to today.
+    :param respondent_ids: The id of every respondent, which always adds the respondent column. By default respondents
+                           are numbered from 0.
+
+    :rtype: Pandas DataFrame
+    """
+    start_date = start_date or date.today()
+    rows = np.arange(offset, offset + size)
+
+    # Step 1: Dates and respondents are derived from the row numbers.
+    weeks = (rows // respondents) % (WEEKS_PER_YEAR * years)
+    data = {'date': pd.Timestamp(start_date) + pd.to_timedelta(weeks * 7, unit='D')}
+    if respondent_ids is not None:
+        data['respondent'] = np.asarray(respondent_ids, dtype=object)[rows % respondents]
+    elif respondents > 1:
+        data['respondent'] = rows % respondents
+
+    # Step 2: Each measurement level is generated as one block of values, which is then split into its columns.
+    values = {}
+    for level, level_columns in plan.measurement_levels.items():
+        low, high = VALUE_RANGES[level]
+        values.update(zip(level_columns, rng.integers(low, high + 1, size=(len(level_columns), size))))
+
+    for column in plan.columns:
+        data[column] = values[column]
+
+    frame = pd.DataFrame(data)
+
+    # Step 3: Answering 0 (no) to a question of a sub goal ends that sub goal, like it does in schema.walk: the 0 and
+    # every question that follows it are left empty.
+    for subgoal_columns in _skip_groups(plan, skippable_only=True):
+        ended = np.zeros(size, dtype=bool)
+        for column in subgoal_columns:
+            ended |= frame[column].to_numpy() == 0
+            frame[column] = frame[column].where(~ended)
+
+    # Step 4: Simulate skipped questions. For every sub goal a row skips with the given chance, starting at a random
+    # question of that sub goal: that question and all that follow it are left empty.
+    if skip_rate > 0:
+        for subgoal_columns in _skip_groups(plan):
+            skipped = rng.random(size) < skip_rate
+            first_skipped = np.where(skipped, rng.integers(0, len(subgoal_columns), size), len(subgoal_columns))
+            for position, column in enumerate(subgoal_columns):
+                frame[column] = frame[column].where(first_skipped > position)
+
+    return frame
+
+
+def _chunks(plan, rows, respondents, years, seed, skip_rate, chunk_size, start_date, respondent_ids=None):
+    """Generate the records chunk by chunk, numbered by their row number over the whole data set."""
+    offsets = range(0, rows, chunk_size)
+    chunk_seeds = np.random.SeedSequence(seed).spawn(len(offsets))
+
+    for chunk_number, offset in enumerate(offsets):
+        rng = np.random.default_rng(chunk_seeds[chunk_number])
+        size = min(chunk_size, rows - offset)
+        chunk = generate_chunk(plan, rng, offset, size, respondents=respondents, years=years, skip_rate=skip_rate,
+                               start_date=start_date, respondent_ids=respondent_ids)
+        chunk.index = pd.RangeIndex(offset, offset + size)
+        yield chunk
+
+
+def generate_test_data(path, plan, rows=WEEKS_PER_YEAR, respondents=1, years=1, seed=None,
+                       skip_rate=0.0, chunk_size=100_000, start_date=None):
+    """Generate random survey records and stream them to a semicolon separated file.
+
+    Chunks are generated and written one at a time, so only a single chunk is kept in memory. Each chunk gets its own
+    random generator derived from the seed and the chunk number, given the same seed and chunk size the output is
+    identical between runs.
+
+    :param path: The file to write the output to, it is overwritten when it exists.
+    :param plan: The compiled survey content, see schema.compile_plan.
+    :param rows: The total number of rows to generate.
+    :param seed: The seed of the random generator, None for a random seed.
+    :param chunk_size: The maximum number of rows kept in memory at once.
+
+    For the remaining parameters, see generate_chunk.
+
+    :return: The number of rows written.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as output:
+        for chunk_number, chunk in enumerate(_chunks(plan, rows, respondents, years, seed, skip_rate, chunk_size,
+                                                     start_date)):
+            chunk.to_csv(output, sep=';', header=chunk_number == 0, date_format='%Y-%m-%d')
+
+    return rows
+
+
+def generate_partitioned_test_data(name, plan, directory='.', rows=WEEKS_PER_YEAR, respondents=1, years=1, seed=None,
+                                   skip_rate=0.0, chunk_size=100_000, start_date=None, respondent_ids=None):
+    """Generate random survey records like generate_test_data does, with the records of every respondent written to a
+    file of their own in the partition of that respondent (see storage.partition_directory).
+
+    :param name: The name of the file written to every partition, it is overwritten when it exists.
+    :param respondent_ids: The id of every respondent, by default respondents are numbered from 0.
+
+    For the remaining parameters, see generate_test_data.
+
+    :return: The paths of the files written, by respondent.
+    :rtype: dict
+    """
+    respondent_ids = list(respondent_ids if respondent_ids is not None else range(respondents))
+    paths = {respondent: os.path.join(storage.partition_directory(respondent, directory), name)
+             for respondent in respondent_ids}
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Every chunk holds records of (nearly) every respondent, each file gets its header with its first records.
+    for chunk in _chunks(plan, rows, len(respondent_ids), years, seed, skip_rate, chunk_size, start_date,
+                         respondent_ids):
+        for respondent, records in chunk.groupby('respondent', sort=False):
+            path = paths[respondent]
+            records.to_csv(path, sep=';', mode='a', header=not os.path.exists(path), date_format='%Y-%m-%d',
+                           encoding='utf-8')
+
+    return paths
@@ -0,0 +1,111 @@
+"""
+This document computes the target columns (t_<goal>) for survey records.
+
+Targets are computed for a complete DataFrame at once, whether that is the single record of this week's survey or the
+history of several years. The rules are declared in survey_content (target_goals, level_targets and goal_targets), so
+after changing a rule the targets of all stored years can be recomputed in one pass with recompute_targets.
+
+"""
+import os
+
+import lazy
+import metrics
+import schema
+import storage
+
+np = lazy.module('numpy')
+pd = lazy.module('pandas')
+
+
+def target_values(content):
+    """Return the target of every goal in content.target_goals.
+
+    :param content: a .py file containing all goals, questions and target rules.
+
+    :rtype: dict
+    """
+    level_of = schema.compile_plan(content).level_of
+    values = {}
+
+    for goal in content.target_goals:
+        if goal in content.goal_targets:
+            values[goal] = content.goal_targets[goal]
+        elif level_of.get(goal) in content.level_targets:
+            values[goal] = content.level_targets[level_of[goal]]
+        else:
+            raise ValueError(f'No target rule found for goal {goal} (measurement level: {level_of.get(goal)})')
+
+    return values
+
+
+def generate_targets(results, content):
+    """Generate targets for each goal that needs it.
+
+    The target is only set when the goal was actually relevant for the record, a goal answered with 0 or not asked at
+    all (NaN) gets a target of 0. Goals that are missing from the results entirely are treated as not asked.
+
+    :param results: The survey records, one row per record.
+    :param content: a .py file containing all goals, questions and target rules.
+
+    :return: A t_<goal> column for every target goal, with the same index as the results.
+    :rtype: Pandas DataFrame
+    """
+    with metrics.span('targets.generate'):
+        targets = {}
+
+        for goal, value in target_values(content).items():
+            if goal in results:
+                answered = results[goal].fillna(0).to_numpy() != 0
+            else:
+                answered = np.zeros(len(results), dtype=bool)
+            targets[f't_{goal}'] = np.where(answered, value, 0)
+
+        return pd.DataFrame(targets, index=results.index)
+
+
+def record_targets(record, content):
+    """Generate the targets of a single record, as a dictionary, following the same rules as generate_targets.
+
+    This leaves pandas out of the survey mode, which only ever handles the one record of this week.
+
+    :param record: The responses by column.
+    :param content: a .py file containing all goals, questions and target rules.
+
+    :return: The target by t_<goal> column.
+    :rtype: dict
+    """
+    targets = {}
+
+    for goal, value in target_values(content).items():
+        response = record.get(goal)
+        answered = response is not None and response == response and response != 0
+        targets[f't_{goal}'] = value if answered else 0
+
+    return targets
+
+
+def apply_targets(results, content):
+    """Return the results with all existing t_ columns replaced by freshly computed targets."""
+    answers = results.drop(columns=[column for column in results.columns if column.startswith('t_')])
+    return pd.concat([answers, generate_targets(answers, content)], axis=1)
+
+
+def recompute_targets(content, directory='.', workers=1):
+    """Recompute the targets of every yearly store found in the directory, those of every respondent included.
+
+    Outstanding records are merged into the yearly files first, after which each file is rewritten once with the new
+    targets. Each store is merged again just before it is rewritten, with no other merge in between (see
+    storage.rewrite_records), records stored while this runs keep the targets they were stored with.
+
+    :param workers: The number of processes merging the stores, see storage.compact_stores.
+
+    :return: The paths of the stores that were updated.
+    """
+    stems = [stem for stem, _ in storage.list_stores(directory)
+             if os.path.basename(stem).startswith('goals_monitoring_')]
+
+    storage.compact_stores(stems, workers)
+    for stem in stems:
+        storage.rewrite_records(stem, lambda frame: apply_targets(frame, content))
+
+    return stems
@@ -0,0 +1,54 @@
+"""
+This document holds the rules that decide whether an answer is valid, for each measurement level.
+
+The same rules apply to every way answers come in: the terminal survey (validate_response), the survey server and the
+bulk import. For the numeric measurement levels an answer of 0 means the question is skipped, for yes_no a no does the
+same.
+    yes_no: yes, y, no and n in any case, transformed to 1 | 0
+    likert_5: an integer between 0 and 5
+    scale_10: a grade (integer or float) between 0 and 10
+    quantity: any integer of 0 or more
+
+"""
+import math
+
+YES_NO_VALUES = {'y': 1, 'yes': 1, 'n': 0, 'no': 0}
+
+# The allowed range (inclusive) and whether only integers are accepted, for the numeric measurement levels.
+NUMERIC_RULES = {
+    'likert_5': (0, 5, True),
+    'scale_10': (0, 10, False),
+    'quantity': (0, math.inf, True),
+}
+
+PROMPTS = {
+    'yes_no': 'Please answer the question with (Y)es or (N)o: ',
+    'likert_5': 'Please give an integer between 1 (Not really) and 5 (Very much so!): ',
+    'scale_10': 'Please enter a grade between 1 and 10: ',
+    'quantity': 'Please enter an integer above 0: ',
+}
+
+
+def parse_response(measurement_level, text):
+    """Validate a single answer as it was entered.
+
+    :param measurement_level: The measurement level of the question, as defined in the content object.
+    :param text: The answer as entered by the respondent.
+
+    :return: The validated response, None if the answer isn't valid.
+    :rtype: integer, float or None
+    """
+    text = str(text).strip().lower()
+
+    if measurement_level == 'yes_no':
+        return YES_NO_VALUES.get(text)
+
+    low, high, integer = NUMERIC_RULES[measurement_level]
+    try:
+        value = int(text) if integer else float(text)
+    except ValueError:
+        return None
+
+    if not low <= value <= high:
+        return None
+    return value
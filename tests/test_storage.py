@@ -0,0 +1,140 @@
+"""
+This document tests the storage layer (storage.py) on what it has to survive: several writers at once, a process
+crashing while writing the log and a merge interrupted halfway. Run with pytest from the repository root.
+
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import schema  # noqa: E402
+import storage  # noqa: E402
+import survey_content  # noqa: E402
+
+PLAN = schema.compile_plan(survey_content)
+COLUMN = PLAN.columns[0]
+
+
+@pytest.fixture
+def stem(tmp_path):
+    return storage.store_stem(2026, str(tmp_path))
+
+
+def _record(number, record_date='2026-10-16'):
+    """Return a record numbered by the answer to its first question, so lost or duplicated records can be told."""
+    record = schema.empty_record(PLAN, record_date)
+    record[COLUMN] = number
+    return record
+
+
+def _numbers(stem):
+    return sorted(int(number) for number in storage.read_records(stem)[COLUMN])
+
+
+def test_concurrent_appends_and_merge(stem):
+    writers, per_writer = 8, 40
+    merges = []
+
+    def write(writer):
+        for number in range(writer * per_writer, (writer + 1) * per_writer):
+            merge = storage.append_record(_record(number), stem)
+            if merge is not None:
+                merges.append(merge)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    threads.append(threading.Thread(target=storage.compact, args=(stem,)))
+    for thread in threads:
+        thread.start()
+    for thread in threads + merges:
+        thread.join()
+    storage.compact(stem)
+
+    assert _numbers(stem) == list(range(writers * per_writer))
+    assert not storage._sealed_segments(stem)
+    assert len(storage.read_records(stem)) == sum(storage.date_index(stem)['records'])
+
+
+def test_append_during_merge_is_stored_once(stem, monkeypatch):
+    storage.append_record(_record(0), stem)
+
+    # A record arrives after the merge sealed the log, just before it reads what it sealed.
+    read_pending = storage._read_pending
+
+    def append_and_read_pending(*args, **kwargs):
+        monkeypatch.setattr(storage, '_read_pending', read_pending)
+        storage.append_record(_record(1), stem)
+        return read_pending(*args, **kwargs)
+
+    monkeypatch.setattr(storage, '_read_pending', append_and_read_pending)
+    storage.compact(stem)
+    assert _numbers(stem) == [0, 1]
+    storage.compact(stem)
+    assert _numbers(stem) == [0, 1]
+
+
+def test_rewrite_leaves_records_appended_meanwhile_in_the_log(stem, monkeypatch):
+    storage.append_record(_record(0), stem)
+    read_pending = storage._read_pending
+
+    def append_and_read_pending(*args, **kwargs):
+        monkeypatch.setattr(storage, '_read_pending', read_pending)
+        storage.append_record(_record(1), stem)
+        return read_pending(*args, **kwargs)
+
+    monkeypatch.setattr(storage, '_read_pending', append_and_read_pending)
+    assert storage.rewrite_records(stem, lambda frame: frame.assign(**{COLUMN: frame[COLUMN] + 10}))
+
+    # Only the merged record is rewritten, the record appended during the merge is read once, as it was written.
+    assert _numbers(stem) == [1, 10]
+    storage.compact(stem)
+    assert _numbers(stem) == [1, 10]
+
+
+def test_truncated_last_line_is_recovered(stem):
+    for number in range(2):
+        storage.append_record(_record(number), stem)
+    with open(storage.log_path(stem), 'a', encoding='utf-8') as log:
+        log.write('{"date": "2026-10-16", "' + COLUMN)
+
+    # The broken line is ignored when reading and removed before the next record is written after it.
+    assert _numbers(stem) == [0, 1]
+    storage.append_record(_record(2), stem)
+    assert _numbers(stem) == [0, 1, 2]
+    with open(storage.log_path(stem), encoding='utf-8') as log:
+        assert len(log.readlines()) == 3
+
+    storage.compact(stem)
+    assert _numbers(stem) == [0, 1, 2]
+
+
+def test_merge_interrupted_after_the_base_swap(stem, monkeypatch):
+    storage.append_record(_record(0), stem)
+    storage.compact(stem)
+    storage.append_record(_record(1), stem, session='interrupted')
+
+    # The process dies right after the new base is swapped in, before the merged segment is removed.
+    write_base = storage._write_base
+
+    def write_base_and_crash(*args):
+        write_base(*args)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(storage, '_write_base', write_base_and_crash)
+    with pytest.raises(KeyboardInterrupt):
+        storage.compact(stem)
+    monkeypatch.undo()
+
+    # The segment left behind is recognised as merged: its record is read once and the next merge removes it.
+    assert len(storage._sealed_segments(stem)) == 1
+    assert _numbers(stem) == [0, 1]
+    assert storage.session_stored(stem, 'interrupted')
+
+    storage.append_record(_record(2), stem)
+    storage.compact(stem)
+    assert not storage._sealed_segments(stem)
+    assert _numbers(stem) == [0, 1, 2]
+    assert storage.session_stored(stem, 'interrupted')